@@ -0,0 +1,367 @@
+###################################################
+# Image Captioning with Deep Reinforcement Learning
+# SJSU CMPE-297-03 | Spring 2020
+#
+#
+# Team:
+# Pratikkumar Prajapati
+# Aashay Mokadam
+# Karthik Munipalle
+###################################################
+
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+from trainers import *
+
+# the synthetic data has the shapes of the preprocessed COCO dataset
+COCO_VOCAB_SIZE = 1004  # words in coco2014_vocab.json, <NULL>, <START>, <END> and <UNK> included
+COCO_FEATURE_DIM = 512  # size of the PCA-reduced VGG16 fc7 image features
+BENCHMARK_RESULTS_FILE = 'benchmarks.json'  # default output file of the benchmark results
+
+
+def make_synthetic_coco(num_train=4096, num_val=1024, num_images=1024, vocab_size=COCO_VOCAB_SIZE, seed=0):
+    """
+    Random dataset with the keys, dtypes and shapes of load_data: random image features, and captions of random
+    words, between <START> and <END>, with random lengths up to MAX_SEQ_LEN
+    @param num_train: number of training captions
+    @param num_val: number of validation captions
+    @param num_images: number of images of each split
+    @param vocab_size: number of words of the vocabulary
+    @param seed: seed of the random data
+    @return: dict:data like the one returned by load_data
+    """
+    rng = np.random.RandomState(seed)
+    idx_to_word = ['<NULL>', '<START>', '<END>', '<UNK>'] + ['word%d' % i for i in range(vocab_size - 4)]
+    data = {
+        "idx_to_word": idx_to_word,
+        "word_to_idx": {word: i for i, word in enumerate(idx_to_word)},
+    }
+
+    for split, num_captions in (('train', num_train), ('val', num_val)):
+        captions = np.zeros((num_captions, MAX_SEQ_LEN), dtype=np.int32)
+        captions[:, 0] = data["word_to_idx"]['<START>']
+        lens = rng.randint(4, MAX_SEQ_LEN + 1, size=num_captions)
+        for i, caption_len in enumerate(lens):
+            captions[i, 1:caption_len - 1] = rng.randint(4, vocab_size, size=caption_len - 2)
+            captions[i, caption_len - 1] = data["word_to_idx"]['<END>']
+
+        data['%s_captions' % split] = captions
+        data['%s_image_idxs' % split] = rng.randint(0, num_images, size=num_captions).astype(np.int32)
+        data['%s_features' % split] = rng.randn(num_images, COCO_FEATURE_DIM).astype(np.float32)
+        data['%s_urls' % split] = np.asarray(['http://images.cocodataset.org/%s2014/%012d.jpg' % (split, i)
+                                              for i in range(num_images)])
+        data['%s_captions_lens' % split] = get_captions_lens(captions)
+
+    data["embeddings"] = None
+    return data
+
+
+def write_synthetic_coco(data, base_dir):
+    """
+    Write a dataset in the files and layout read by load_data
+    @param data: dict:data returned by make_synthetic_coco
+    @param base_dir: dir where the dataset is written
+    """
+    os.makedirs(base_dir, exist_ok=True)
+    (captions_file, _), (train_feat_file, _), (val_feat_file, _) = get_h5_files(pca_features=True)
+    with h5py.File(os.path.join(base_dir, captions_file), 'w') as f:
+        for key in ['train_captions', 'train_image_idxs', 'val_captions', 'val_image_idxs']:
+            f.create_dataset(key, data=data[key])
+    for split, feat_file in (('train', train_feat_file), ('val', val_feat_file)):
+        with h5py.File(os.path.join(base_dir, feat_file), 'w') as f:
+            f.create_dataset('features', data=data['%s_features' % split])
+        with open(os.path.join(base_dir, '%s2014_urls.txt' % split), 'w') as f:
+            f.write('\n'.join(data['%s_urls' % split]) + '\n')
+    with open(os.path.join(base_dir, 'coco2014_vocab.json'), 'w') as f:
+        json.dump({"idx_to_word": data["idx_to_word"], "word_to_idx": data["word_to_idx"]}, f)
+
+
+def get_benchmark_batch(data, batch_size, split='train', seed=0):
+    """
+    @param data: the dataset
+    @param batch_size: size of the batch
+    @param split: whether to sample the train or val set
+    @param seed: seed of the sampled items
+    @return: captions (long), image_features (float) and caption lengths (long) on the device, as in training
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    captions, features, _, lens = next(get_coco_minibatches(data, batch_size=batch_size, split=split,
+                                                            with_lens=True, generator=generator))
+    return (torch.from_numpy(np.asarray(captions, dtype=np.int64)).to(device),
+            torch.from_numpy(np.asarray(features, dtype=np.float32)).to(device),
+            torch.from_numpy(np.asarray(lens, dtype=np.int64)).to(device))
+
+
+def sync_device():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def benchmark(fn, items, repeats=5, warmup=1):
+    """
+    Time the calls of a function
+    @param fn: function to time, called without arguments
+    @param items: number of items (captions, images...) processed by one call
+    @param repeats: number of timed calls
+    @param warmup: number of calls before the timed ones
+    @return: dict of latency (seconds per call) statistics and throughput (items per second)
+    """
+    for _ in range(warmup):
+        fn()
+    sync_device()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        sync_device()
+        times.append(time.perf_counter() - start)
+
+    times = np.asarray(times)
+    return {
+        "items": items,
+        "repeats": repeats,
+        "latency_mean": float(times.mean()),
+        "latency_median": float(np.median(times)),
+        "latency_min": float(times.min()),
+        "latency_max": float(times.max()),
+        "latency_std": float(times.std()),
+        "throughput": float(items / np.median(times)),
+    }
+
+
+def get_benchmark_networks(data, seed=0):
+    """
+    @param data: the dataset
+    @param seed: seed of the initial weights
+    @return: randomly initialized policy, value and reward networks
+    """
+    torch.manual_seed(seed)
+    policy_network = PolicyNetwork(data["word_to_idx"], pretrained_embeddings=data["embeddings"]).to(device)
+    value_network = ValueNetwork(data["word_to_idx"], pretrained_embeddings=data["embeddings"]).to(device)
+    reward_network = RewardNetwork(data["word_to_idx"], pretrained_embeddings=data["embeddings"]).to(device)
+    return policy_network, value_network, reward_network
+
+
+def get_network_benchmarks(data, batch_size, seed=0):
+    """
+    Forward and forward + backward passes of the networks, on a training batch as used by their pretraining
+    @return: dict of benchmark name -> (function, number of items per call)
+    """
+    policy_network, value_network, reward_network = get_benchmark_networks(data, seed)
+    captions, features, lens = get_benchmark_batch(data, batch_size, seed=seed)
+
+    def policy_forward():
+        return MaskedCaptionLoss(policy_network(features.unsqueeze(0), captions[:, :-1]), captions[:, 1:], lens)
+
+    def value_forward():
+        return value_network(features, captions).pow(2).mean()
+
+    def reward_forward():
+        return VisualSemanticEmbeddingLoss(*reward_network(features, captions))
+
+    def backward(forward, network):
+        def fn():
+            network.zero_grad()
+            forward().backward()
+        return fn
+
+    def no_grad(forward):
+        def fn():
+            with torch.no_grad():
+                forward()
+        return fn
+
+    return {
+        "policy_network_forward": (no_grad(policy_forward), batch_size),
+        "policy_network_forward_backward": (backward(policy_forward, policy_network), batch_size),
+        "value_network_forward": (no_grad(value_forward), batch_size),
+        "value_network_forward_backward": (backward(value_forward, value_network), batch_size),
+        "reward_network_forward": (no_grad(reward_forward), batch_size),
+        "reward_network_forward_backward": (backward(reward_forward, reward_network), batch_size),
+    }
+
+
+def get_captioning_benchmarks(data, batch_size, seed=0):
+    """
+    Caption generation as in testing, and one A2C rollout as in a2c_training: sampled captions of the length of
+    the longest caption of the batch and the rewards of all their prefixes
+    @return: dict of benchmark name -> (function, number of items per call)
+    """
+    policy_network, value_network, reward_network = get_benchmark_networks(data, seed)
+    reward_network.requires_grad_(False)
+    a2c_network = AdvantageActorCriticNetwork(value_network, policy_network).to(device)
+    captions, features, lens = get_benchmark_batch(data, batch_size, seed=seed)
+    val_captions, val_features, _ = get_benchmark_batch(data, batch_size, split='val', seed=seed)
+    sampler = ActionSampler(seed=seed)
+
+    def greedy():
+        with torch.no_grad():
+            GenerateCaptionsGreedy(val_features, val_captions, policy_network)
+
+    def lookahead():
+        with torch.no_grad():
+            GenerateCaptionsWithActorCriticLookAhead(val_features, val_captions, policy_network, value_network,
+                                                     most_likely=True)
+
+    def a2c_rollout():
+        captions_in = captions[:, :1]
+        values, log_probs = [], []
+        for step in range(int(lens.max()) - 1):
+            value, probs = a2c_network(features, captions_in)
+            actions = sampler(probs[:, 0])
+            captions_in = torch.cat((captions_in, actions.unsqueeze(-1)), axis=1)
+            values.append(value)
+            log_probs.append(F.log_softmax(probs[:, 0], dim=1).gather(1, actions.unsqueeze(-1)))
+        rewards = GetPrefixRewards(features, captions_in, reward_network, start=1)
+        return torch.stack(values, axis=1), torch.stack(log_probs, axis=1), rewards
+
+    return {
+        "generate_captions_greedy": (greedy, batch_size),
+        "generate_captions_lookahead": (lookahead, batch_size),
+        "a2c_rollout": (a2c_rollout, batch_size),
+    }
+
+
+def get_data_benchmarks(data, base_dir, batch_size, seed=0):
+    """
+    Loading the dataset from its HDF5 files and decoding a batch of captions
+    @return: dict of benchmark name -> (function, number of items per call)
+    """
+    write_synthetic_coco(data, base_dir)
+    num_captions = data["train_captions"].shape[0] + data["val_captions"].shape[0]
+    captions, _, _ = get_benchmark_batch(data, batch_size, split='val', seed=seed)
+    captions = captions.cpu()
+
+    return {
+        "load_data": (lambda: load_data(base_dir), num_captions),
+        "decode_captions": (lambda: decode_captions(captions, data["idx_to_word"]), batch_size),
+    }
+
+
+def get_score_benchmarks(data, score_size, seed=0):
+    """
+    Scoring of captions as in calculate_a2cNetwork_score: random validation captions against random others.
+    METEOR is left out, it needs java and fast_score does not compute it
+    @return: dict of benchmark name -> (function, number of items per call)
+    """
+    rng = np.random.RandomState(seed)
+    captions = decode_captions(data["val_captions"], data["idx_to_word"])
+    refs = {i: [captions[j]] for i, j in enumerate(rng.randint(len(captions), size=score_size))}
+    hypo = {i: [captions[j]] for i, j in enumerate(rng.randint(len(captions), size=score_size))}
+
+    return {
+        "metrics_score": (lambda: score(refs, hypo, meteor=False), score_size),
+        "metrics_fast_score": (lambda: fast_score(refs, hypo), score_size),
+    }
+
+
+def get_git_commit():
+    """
+    @return: the commit of the benchmarked code, None outside of a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(batch_size=128, score_size=1000, repeats=5, warmup=1, seed=0, threads=None, only=None):
+    """
+    Run the benchmarks on synthetic COCO-shaped data
+    @param batch_size: number of captions of the network, captioning and decoding benchmarks
+    @param score_size: number of captions scored by the metrics benchmarks
+    @param repeats: number of timed calls of each benchmark
+    @param warmup: number of untimed calls before the timed ones
+    @param seed: seed of the data and of the networks' weights
+    @param threads: (optional) number of torch threads, fixed for comparable results across machines
+    @param only: (optional) names of the benchmarks to run, all of them if None
+    @return: dict with the configuration of the run and the results of every benchmark
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    data = make_synthetic_coco(seed=seed)
+
+    results = {
+        "config": {
+            "commit": get_git_commit(),
+            "date": datetime.now().isoformat(timespec='seconds'),
+            "device": str(device),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "threads": torch.get_num_threads(),
+            "batch_size": batch_size,
+            "score_size": score_size,
+            "repeats": repeats,
+            "warmup": warmup,
+            "seed": seed,
+            "vocab_size": len(data["idx_to_word"]),
+            "max_seq_len": MAX_SEQ_LEN,
+        },
+        "benchmarks": {},
+    }
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        # (benchmark names, suite), a suite is only built when one of its benchmarks runs
+        suites = [
+            (["policy_network_forward", "policy_network_forward_backward", "value_network_forward",
+              "value_network_forward_backward", "reward_network_forward", "reward_network_forward_backward"],
+             lambda: get_network_benchmarks(data, batch_size, seed)),
+            (["generate_captions_greedy", "generate_captions_lookahead", "a2c_rollout"],
+             lambda: get_captioning_benchmarks(data, batch_size, seed)),
+            (["load_data", "decode_captions"], lambda: get_data_benchmarks(data, base_dir, batch_size, seed)),
+            (["metrics_score", "metrics_fast_score"], lambda: get_score_benchmarks(data, score_size, seed)),
+        ]
+        if only is not None:
+            unknown = set(only) - {name for names, _ in suites for name in names}
+            if unknown:
+                raise ValueError("Unknown benchmarks", sorted(unknown))
+        for names, suite in suites:
+            if only is not None and not set(names) & set(only):
+                continue
+            for name, (fn, items) in suite().items():
+                if only is not None and name not in only:
+                    continue
+                print_green(f'[Benchmark] {name}')
+                try:
+                    results["benchmarks"][name] = benchmark(fn, items, repeats, warmup)
+                except Exception as e:
+                    # the other benchmarks are still worth comparing
+                    print_red(f'[Benchmark] {name} failed: {e!r}')
+                    results["benchmarks"][name] = {"error": repr(e)}
+                    continue
+                print('%s: %.3fms median, %.1f items/s' % (name, 1000 * results["benchmarks"][name]["latency_median"],
+                                                           results["benchmarks"][name]["throughput"]))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the image captioning pipeline on synthetic COCO data')
+    parser.add_argument('--output', type=str, help='JSON file the results are written to',
+                        default=BENCHMARK_RESULTS_FILE)
+    parser.add_argument('--batch_size', type=int, help='Number of captions per call of the model benchmarks',
+                        default=128)
+    parser.add_argument('--score_size', type=int, help='Number of captions scored by the metrics benchmarks',
+                        default=1000)
+    parser.add_argument('--repeats', type=int, help='Number of timed calls of each benchmark', default=5)
+    parser.add_argument('--warmup', type=int, help='Number of untimed calls before the timed ones', default=1)
+    parser.add_argument('--seed', type=int, help='Seed of the synthetic data and network weights', default=0)
+    parser.add_argument('--threads', type=int, help='Number of torch threads (0 to keep the default)', default=1)
+    parser.add_argument('--only', type=str, nargs='+', help='Only run these benchmarks', default=None)
+    args = parser.parse_args()
+
+    results = run_benchmarks(batch_size=args.batch_size, score_size=args.score_size, repeats=args.repeats,
+                             warmup=args.warmup, seed=args.seed, threads=args.threads if args.threads else None,
+                             only=args.only)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print_green(f'[Benchmark] Results saved in: {args.output}')
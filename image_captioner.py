@@ -17,9 +17,8 @@ import warnings
 # defaults and params
 device = "cuda"
 BASE_DIR = os.path.join('datasets', 'coco_captioning')  # path of the dataset
-REAL_CAPTIONS_FILE = 'real_captions.txt'  # actual captions from the dataset stored in this file, for scoring
-GENERATED_CAPTIONS_FILE = 'generated_captions.txt'  # generated captions are stored in this file, for scoring
-IMAGE_URL_FILENAME = 'image_url.txt'  # actual image urls from the dataset stored in this file, for viewing results
+# real caption, generated caption and image url of every test item are stored in this file, for scoring and viewing
+CAPTION_RESULTS_FILE = 'caption_results.jsonl'
 LOG_DIR = ""  # all logs are save in this LOG_DIR, a value gets assigned based on execution date-time stamp
 
 # network weight files
@@ -27,6 +26,7 @@ A2C_NETWORK_WEIGHTS_FILE = 'a2cNetwork.pt'
 REWARD_NETWORK_WEIGHTS_FILE = 'rewardNetwork.pt'
 POLICY_NETWORK_WEIGHTS_FILE = 'policyNetwork.pt'
 VALUE_NETWORK_WEIGHTS_FILE = 'valueNetwork.pt'
+TRAINING_STATE_FILE = 'a2cTrainingState.pt'  # optimizer, random generators and data position to resume the training
 
 RESULTS_FILE = 'results.txt'  # various scores are saved in this file
 BEST_SCORE_FILENAME = 'best_scores.txt'  # post-processing stage saves best results in this file
@@ -35,6 +35,23 @@ BEST_SCORE_IMAGES_PATH = 'best_scores_images'  # # post-processing stage downloa
 CURRICILUM_LEVELS = [3, 6, 9, 12, 15]
 
 
+def profile_steps(value):
+    """
+    argparse type of --profile
+    @param value: START:STOP range of minibatches to trace, empty to only time the phases
+    @return: tuple (start, stop), empty tuple without a range
+    """
+    if not value:
+        return ()
+    try:
+        start, stop = (int(step) for step in value.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected START:STOP minibatch indices, got {value!r}')
+    if not 0 <= start < stop:
+        raise argparse.ArgumentTypeError(f'expected 0 <= START < STOP, got {value!r}')
+    return start, stop
+
+
 def setup(args):
     """
     Create various configurations based on args.
@@ -63,18 +80,18 @@ def setup(args):
     policy_file = get_filename(POLICY_NETWORK_WEIGHTS_FILE, args.bidirectional, None)
     value_file = get_filename(VALUE_NETWORK_WEIGHTS_FILE, args.bidirectional, None)
     a2c_file = get_filename(A2C_NETWORK_WEIGHTS_FILE, args.bidirectional, args.curriculum)
+    training_state_file = get_filename(TRAINING_STATE_FILE, args.bidirectional, args.curriculum)
     results_file = get_filename(RESULTS_FILE, args.bidirectional, args.curriculum)
-    generated_captions_file = get_filename(GENERATED_CAPTIONS_FILE, args.bidirectional, args.curriculum)
+    caption_results_file = get_filename(CAPTION_RESULTS_FILE, args.bidirectional, args.curriculum)
 
     save_paths = {
         "model_path": os.path.join(LOG_DIR, a2c_file),
         "results_path": os.path.join(LOG_DIR, results_file),
+        "resume_path": os.path.join(LOG_DIR, training_state_file),
     }
 
     image_caption_data = {
-        "real_captions_path": os.path.join(LOG_DIR, REAL_CAPTIONS_FILE),
-        "generated_captions_path": os.path.join(LOG_DIR, generated_captions_file),
-        "image_urls_path": os.path.join(LOG_DIR, IMAGE_URL_FILENAME),
+        "caption_results_path": os.path.join(LOG_DIR, caption_results_file),
         "best_score_file_path": os.path.join(LOG_DIR, BEST_SCORE_FILENAME),
         "best_score_images_path": os.path.join(LOG_DIR, BEST_SCORE_IMAGES_PATH),
     }
@@ -102,19 +119,20 @@ def main(args):
     max_train = None if args.training_size == 0 else args.training_size  # set None for whole training dataset
     max_train_str = '' if max_train == None else str(max_train)
     print_green(f'[Info] Loading COCO dataset {max_train_str}')
-    data = load_data(base_dir=BASE_DIR, max_train=max_train, print_keys=True)
+    mmap_dir = args.mmap_dir if args.mmap_dir else None
+    cache_dir = args.cache_dir if args.cache_dir else None
+    data = load_preprocessed_data(base_dir=BASE_DIR, max_train=max_train, embedding_type=args.train_word2vec,
+                                  cache_dir=cache_dir, mmap_dir=mmap_dir, print_keys=True)
     print_green(f'[Info] COCO dataset loaded')
 
-    train_corpus = None
-    if args.train_word2vec != "none":
-        print_green(f'[Info] Loading Word Embeddings {args.train_word2vec}')
-        print_green(f'[Info] Loading Corpus')
-        train_corpus = get_preprocessed_corpus(BASE_DIR)
-        print_green(f'[Info] Corpus Loaded With {len(train_corpus)} Lines')
-        data["embeddings"] = train_word_embeddings(args.train_word2vec, data, train_corpus)
-        print_green(f'[Info] Done Loading Word Embeddings')
-    else:
-        data["embeddings"] = None
+    precision = MixedPrecision(args.mixed_precision)
+    if args.mixed_precision:
+        print_green(f'[Info] Mixed precision enabled: {precision.dtype}')
+
+    trace_steps = args.profile if args.profile else None
+    profiler = Profiler(args.profile is not None, trace_steps, log_dir=os.path.join(LOG_DIR, 'runs'))
+    if args.profile is not None:
+        print_green(f'[Info] Profiling the A2C training, time breakdown saved in: {profiler.log_dir}')
 
     if os.path.isfile(args.test_model) and "a2cNetwork" in os.path.split(args.test_model)[1]:
         print_green(f'[Info] Loading A2C Network')
@@ -127,20 +145,40 @@ def main(args):
             curriculum = None
 
         print_green(f'[Info] Training A2C Network')
-        a2c_network = train_a2c_network(train_data=data, \
-                                        save_paths=save_paths, network_paths=network_paths, \
-                                        plot_dir=LOG_DIR, epochs=args.epochs, batch_size=args.batch_size, \
-                                        bidirectional=args.bidirectional, retrain_all=args.retrain,
-                                        curriculum=curriculum)
+        train_args = dict(train_data=data, save_paths=save_paths, network_paths=network_paths, \
+                          plot_dir=LOG_DIR, epochs=args.epochs, batch_size=args.batch_size, \
+                          bidirectional=args.bidirectional, retrain_all=args.retrain, curriculum=curriculum,
+                          sampler=ActionSampler(args.temperature, args.top_k, args.seed),
+                          bucketed=args.bucket_by_length, actors=args.rollout_actors,
+                          max_staleness=args.max_staleness, precision=precision,
+                          resume_from=args.resume if args.resume else None, profiler=profiler)
+        if args.workers > 1:
+            seed = 0 if args.seed is None else args.seed
+            train_data_parallel(args.workers, train_a2c_network, seed=seed, **train_args)
+            a2c_network = load_a2c_models(save_paths["model_path"], data, network_paths, args.bidirectional)
+        else:
+            a2c_network = train_a2c_network(**train_args)
         print_green(f'[Info] A2C Network trained')
 
     print_green(f'[Info] Testing A2C Network')
+    eval_shards = None if args.eval_shards == 0 else args.eval_shards
     test_a2c_network(a2c_network, test_data=data, \
-                     image_caption_data=image_caption_data, data_size=args.test_size)
+                     image_caption_data=image_caption_data, data_size=args.test_size,
+                     full_validation=args.full_validation, shards=eval_shards, precision=precision)
     print_green(f'[Info] A2C Network Tested')
 
+    if args.mixed_precision:
+        print_green(f'[Info] Mixed precision accuracy check against float32')
+        precision_report = str(check_mixed_precision(a2c_network, data, precision))
+        print(precision_report)
+        with open(save_paths["results_path"], 'a') as f:
+            f.write('\n' + '-' * 10 + ' mixed precision check ' + '-' * 10 + '\n')
+            f.write(precision_report)
+            f.write('\n' + '-' * 10 + ' mixed precision check ' + '-' * 10 + '\n')
+
     print_green(f'[Info] A2C Network score - start')
-    calculate_a2cNetwork_score(image_caption_data, save_paths)
+    score_workers = None if args.score_workers == 0 else args.score_workers
+    calculate_a2cNetwork_score(image_caption_data, save_paths, workers=score_workers)
     print_green(f'[Info] A2C Network score - end')
 
     if args.postprocess:
@@ -157,14 +195,44 @@ if __name__ == "__main__":
 
     parser.add_argument('--training_size', type=int, help='Size of the training set to use (set 0 for the full set)',
                         default=0)
+    parser.add_argument('--mmap_dir', type=str,
+                        help='Memory-map the dataset from this dir (converted from the HDF5 files on first use)',
+                        default="")
+    parser.add_argument('--cache_dir', type=str,
+                        help='Cache the preprocessed dataset and word embeddings here to skip them on later runs',
+                        default="")
     parser.add_argument('--test_size', type=int, help='Size of the test set to use', default=40504)
+    parser.add_argument('--full_validation', action='store_true',
+                        help='Test on every item of the val split once, in dataset order (ignores --test_size)',
+                        default=False)
+    parser.add_argument('--eval_shards', type=int,
+                        help='Number of processes the full validation is split in (0 for one per core)', default=1)
 
     parser.add_argument('--epochs', type=int, help='Number of Epochs to use for Training the A2C Network', default=100)
     parser.add_argument('--batch_size', type=int,
                         help='Number of Episodes (Batch Size) to use for Training the A2C Network', default=512)
 
+    parser.add_argument('--workers', type=int,
+                        help='Number of data-parallel training processes (the batch size is per process)', default=1)
+    parser.add_argument('--rollout_actors', type=int,
+                        help='Number of rollout processes feeding the A2C learner (0 to roll out in the training loop)',
+                        default=0)
+    parser.add_argument('--max_staleness', type=int,
+                        help='Max number of updates a rollout may lag behind the A2C learner before it is dropped',
+                        default=4)
+    parser.add_argument('--mixed_precision', action='store_true',
+                        help='Autocast the networks to bfloat16 (float16 with loss scaling on older GPUs) and check '
+                             'the accuracy of the tested network against float32', default=False)
+    parser.add_argument('--resume', type=str,
+                        help='Resume an interrupted A2C training from its training state file (a2cTrainingState*.pt)',
+                        default="")
+    parser.add_argument('--profile', type=profile_steps, nargs='?', const="",
+                        help='Time the phases of the A2C training loop, per epoch, in runs/profile.txt. Optionally '
+                             'also trace minibatches START:STOP (e.g. 10:15) with torch.profiler', default=None)
     parser.add_argument('--retrain', action='store_true', help='Whether to retrain value, policy and reward networks',
                         default=False)
+    parser.add_argument('--score_workers', type=int,
+                        help='Number of processes used to score the captions (0 for one per core)', default=0)
     parser.add_argument('--postprocess', action='store_true',
                         help='Post process data to download images from the validation cycle', default=False)
 
@@ -172,6 +240,14 @@ if __name__ == "__main__":
     parser.add_argument('--bidirectional', action='store_true', help='Use bidirectional recurrent neural networks',
                         default=False)
 
+    parser.add_argument('--bucket_by_length', action='store_true',
+                        help='Batch captions of the same length together to shorten A2C rollouts', default=False)
+    parser.add_argument('--temperature', type=float, help='Softmax temperature used to sample A2C rollouts',
+                        default=1.0)
+    parser.add_argument('--top_k', type=int, help='Sample A2C rollouts among the top k words only (0 to disable)',
+                        default=0)
+    parser.add_argument('--seed', type=int, help='Seed for reproducible rollout sampling', default=None)
+
     parser.add_argument('--test_model', type=str, help='Test a pretrained advantage actor critic model', default="")
     parser.add_argument('--pretrained_path', type=str, help='Location of pretrained model files',
                         default="models_pretrained")
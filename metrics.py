@@ -15,6 +15,11 @@ using the COCO metrics scripts
 """
 import os
 import sys
+import io
+import hashlib
+import contextlib
+import multiprocessing
+import numpy as np
 
 # this requires the coco-caption package, https://github.com/tylin/coco-caption
 from pycocoevalcap.bleu.bleu import Bleu
@@ -23,6 +28,15 @@ from pycocoevalcap.cider.cider import Cider
 from pycocoevalcap.meteor.meteor import Meteor
 
 
+def remove_special_tokens(sentence):
+    """
+    @param sentence: decoded caption
+    @return: the caption without the <START>, <END> and <UNK> tokens, as scored by the metrics
+    """
+    return " ".join([w for w in sentence.split(' ') if
+                     ('<END>' not in w and '<START>' not in w and '<UNK>' not in w and '\n' not in w)])
+
+
 def load_text_data(filename):
     """
     ## Code taken from https://github.com/kelvinxu/arctic-captions/blob/master/metrics.py and made further changes
@@ -30,9 +44,7 @@ def load_text_data(filename):
     contents_file = open(filename, "r")
     contents = []
     for x in contents_file:
-        d = " ".join([w for w in x.split(' ') if
-                      ('<END>' not in w and '<START>' not in w and '<UNK>' not in w and '\n' not in w)])
-        contents.append(d)
+        contents.append(remove_special_tokens(x))
     return contents
 
 
@@ -54,34 +66,41 @@ def load_textfiles(reference_file, hypothesis_file):
     return refs, hypo
 
 
-def score(ref, hypo):
+def get_scorers(meteor=True):
+    """
+    @param meteor: whether to include METEOR (it needs java)
+    @return: list of (scorer, metric name(s)) tuples
+    """
+    scorers = [(Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"])]
+    if meteor:
+        scorers.append((Meteor(), "METEOR"))
+    return scorers + [
+        (Rouge(), "ROUGE_L"),
+        (Cider(), "CIDEr")
+    ]
+
+
+def score(ref, hypo, meteor=True):
     """
     ## Code taken from https://github.com/kelvinxu/arctic-captions/blob/master/metrics.py and made further changes
     """
 
-    # block prints
-    sys.stdout = open(os.devnull, 'w')
     """
     ref, dictionary of reference sentences (id, sentence)
     hypo, dictionary of hypothesis sentences (id, sentence)
+    meteor, whether to compute METEOR too (it needs java)
     score, dictionary of scores
     """
-    scorers = [
-        (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-        (Meteor(), "METEOR"),
-        (Rouge(), "ROUGE_L"),
-        (Cider(), "CIDEr")
-    ]
     final_scores = {}
-    for scorer, method in scorers:
-        score, scores = scorer.compute_score(ref, hypo)
-        if type(score) == list:
-            for m, s in zip(method, score):
-                final_scores[m] = s
-        else:
-            final_scores[method] = score
-    # enable print
-    sys.stdout = sys.__stdout__
+    # block prints
+    with contextlib.redirect_stdout(io.StringIO()):
+        for scorer, method in get_scorers(meteor):
+            score, scores = scorer.compute_score(ref, hypo)
+            if type(score) == list:
+                for m, s in zip(method, score):
+                    final_scores[m] = s
+            else:
+                final_scores[method] = score
     return final_scores
 
 
@@ -89,3 +108,497 @@ def get_singleton_score(reference, hypothesis):
     refs = {0: [reference.strip()]}
     hypo = {0: [hypothesis.strip()]}
     return score(refs, hypo)
+
+
+def score_per_sentence(ref, hypo):
+    """
+    Score every hypothesis on its own, with the scorers created once and a single compute_score call per metric
+    (instead of calling get_singleton_score for each line). CIDEr document frequencies come from all the references.
+
+    ref, dictionary of reference sentences (id, sentence)
+    hypo, dictionary of hypothesis sentences (id, sentence)
+    @return: dictionary of metric name -> np.array of per-sentence scores, in the order of ref.keys()
+    """
+    sentence_scores = {}
+    # block prints
+    with contextlib.redirect_stdout(io.StringIO()):
+        for scorer, method in get_scorers():
+            _, scores = scorer.compute_score(ref, hypo)
+            if type(method) == list:
+                for m, s in zip(method, scores):
+                    sentence_scores[m] = np.asarray(s, dtype=np.float64)
+            else:
+                sentence_scores[method] = np.asarray(scores, dtype=np.float64)
+    return sentence_scores
+
+
+# Built-in BLEU, ROUGE-L and CIDEr-D engine, reproducing the coco-caption scorers above without Java.
+# Words and n-grams are hashed once into integer ids, the reference side (BLEU max counts, CIDEr document
+# frequencies and tf-idf vectors, ROUGE token matrices) is indexed once, and all the hypotheses are then
+# scored together with numpy.
+
+NGRAM_ID_BITS = 31  # word and n-gram ids stay below 2 ** 31, so (row, id) pairs pack into a single int64 key
+NGRAM_ID_MASK = (1 << NGRAM_ID_BITS) - 1
+NGRAM_KEY_PRIME = 0x100000001B3  # mixes the key of an n-gram's prefix with its last word into a 64-bit key
+
+
+def tokenize_to_ids(sentences, vocab, grow=False):
+    """
+    Map tokenized sentences to word ids
+    @param sentences: list of lists of words
+    @param vocab: dict of word -> id
+    @param grow: whether unseen words are added to vocab, otherwise they get temporary ids past the end of it
+    @return: tuple of the flat array of word ids and the array of sentence lengths
+    """
+    extra = {}
+    ids = []
+    lens = np.empty(len(sentences), dtype=np.int64)
+    for i, words in enumerate(sentences):
+        lens[i] = len(words)
+        for w in words:
+            wid = vocab.get(w)
+            if wid is None:
+                if grow:
+                    wid = vocab[w] = len(vocab)
+                else:
+                    wid = extra.setdefault(w, len(vocab) + len(extra))
+            ids.append(wid)
+    return np.asarray(ids, dtype=np.int64), lens
+
+
+def lookup_ngram_ids(keys, table):
+    """
+    Ids of n-gram keys in a sorted table of known keys. Unknown keys get new ids past the end of the table.
+    @param keys: n-gram keys
+    @param table: sorted array of unique known keys
+    @return: array of ids
+    """
+    if table.shape[0] == 0:
+        _, ids = np.unique(keys, return_inverse=True)
+        return ids.reshape(-1)
+
+    idx = np.minimum(np.searchsorted(table, keys), table.shape[0] - 1)
+    found = table[idx] == keys
+    ids = np.where(found, idx, -1)
+    if not found.all():
+        _, unseen = np.unique(keys[~found], return_inverse=True)
+        ids[~found] = table.shape[0] + unseen.reshape(-1)
+    return ids
+
+
+def get_ngram_counts(words, lens, tables, n=4):
+    """
+    Count the n-grams of order 1 to n of every sentence. The key of an n-gram is built from the id of its
+    (n-1)-gram prefix and its last word, and mapped to a compact id through tables.
+    @param words: flat array of word ids
+    @param lens: sentence lengths
+    @param tables: list of the sorted known keys of every order. An empty list is filled in with the keys seen here
+    @param n: max n-gram order
+    @return: list over orders of (sentence index, n-gram id, count) arrays, sorted by sentence then id
+    """
+    build = len(tables) == 0
+    num_words = words.shape[0]
+    starts = np.cumsum(lens) - lens
+    sentence = np.repeat(np.arange(lens.shape[0]), lens)
+    ends = np.repeat(starts + lens, lens)
+    positions = np.arange(num_words)
+
+    counts = []
+    prefix_ids = None
+    for k in range(n):
+        # n-gram of order k + 1 starting at every position that leaves enough words in its sentence
+        valid = positions + k < ends
+        if k == 0:
+            keys = words
+        else:
+            last_words = words[np.minimum(positions + k, max(num_words - 1, 0))]
+            keys = np.where(valid, (prefix_ids << NGRAM_ID_BITS) + last_words, -1)
+
+        if build:
+            tables.append(np.unique(keys[valid]))
+        ids = np.full(num_words, -1, dtype=np.int64)
+        ids[valid] = lookup_ngram_ids(keys[valid], tables[k])
+        prefix_ids = ids
+
+        pairs, cnt = np.unique((sentence[valid] << NGRAM_ID_BITS) + ids[valid], return_counts=True)
+        counts.append((pairs >> NGRAM_ID_BITS, pairs & NGRAM_ID_MASK, cnt))
+    return counts
+
+
+def lookup_sorted(table, values, keys):
+    """
+    @param table: sorted array of unique keys
+    @param values: value of every key in table
+    @param keys: keys to look up
+    @return: values of keys, 0 for keys missing from table
+    """
+    if table.shape[0] == 0:
+        return np.zeros(keys.shape[0], dtype=values.dtype)
+    idx = np.minimum(np.searchsorted(table, keys), table.shape[0] - 1)
+    return np.where(table[idx] == keys, values[idx], 0)
+
+
+def pad_token_ids(words, lens, fill):
+    """
+    @return: (num sentences, max length) matrix of word ids padded with fill
+    """
+    padded = np.full((lens.shape[0], max(int(lens.max(initial=0)), 1)), fill, dtype=np.int64)
+    offsets = np.arange(words.shape[0]) - np.repeat(np.cumsum(lens) - lens, lens)
+    padded[np.repeat(np.arange(lens.shape[0]), lens), offsets] = words
+    return padded
+
+
+def batched_lcs(refs, cands, ref_lens, cand_lens):
+    """
+    Longest common subsequence length of every (reference, candidate) pair, row by row over the reference.
+    Rows of the LCS table are non-decreasing, so each row is a cumulative max over the previous one.
+    @param refs: (P, Lr) padded reference ids
+    @param cands: (P, Lc) padded candidate ids, padded with a different value than refs
+    @param ref_lens: (P,) reference lengths
+    @param cand_lens: (P,) candidate lengths
+    @return: (P,) LCS lengths
+    """
+    num_pairs = refs.shape[0]
+    table = np.zeros((num_pairs, cands.shape[1] + 1), dtype=np.int64)
+    lcs = np.zeros(num_pairs, dtype=np.int64)
+    rows = np.arange(num_pairs)
+    for i in range(refs.shape[1]):
+        match = refs[:, i:i + 1] == cands
+        best = np.maximum(table[:, 1:], np.where(match, table[:, :-1] + 1, 0))
+        table[:, 1:] = np.maximum.accumulate(best, axis=1)
+        done = ref_lens == i + 1
+        lcs[done] = table[rows[done], cand_lens[done]]
+    return lcs
+
+
+def index_ngrams(ref_sentences, ref_image, hypo_sentences=(), n=4):
+    """
+    Index the n-grams of the references, and of the hypotheses so that they get ids too, and count the
+    document frequency of every n-gram: the number of images whose references contain it
+    @param ref_sentences: list of reference sentences
+    @param ref_image: index of the image of every reference
+    @param hypo_sentences: (optional) list of hypothesis sentences
+    @param n: max n-gram order
+    @return: tuple of the vocab, the n-gram tables (see get_ngram_counts), the reference lengths, the n-gram
+             counts of the references and the document frequencies of every order
+    """
+    vocab = {}
+    tables = []
+    words, lens = tokenize_to_ids([s.split() for s in list(ref_sentences) + list(hypo_sentences)], vocab, grow=True)
+    counts = get_ngram_counts(words, lens, tables, n)
+
+    num_refs = len(ref_sentences)
+    ref_counts = []
+    doc_freq = []
+    for k, (sent, gram, cnt) in enumerate(counts):
+        ref = sent < num_refs
+        ref_counts.append((sent[ref], gram[ref], cnt[ref]))
+        image_keys = np.unique((ref_image[sent[ref]] << NGRAM_ID_BITS) + gram[ref])
+        doc_freq.append(np.bincount(image_keys & NGRAM_ID_MASK, minlength=tables[k].shape[0]).astype(np.float64))
+    return vocab, tables, lens[:num_refs], ref_counts, doc_freq
+
+
+def get_ngram_keys(vocab, tables):
+    """
+    Keys of the indexed n-grams that only depend on their words, so that the n-grams indexed for different
+    shards of a corpus can be matched
+    @param vocab: dict of word -> id
+    @param tables: n-gram tables (see get_ngram_counts)
+    @return: list over orders of the uint64 key of every entry of the table
+    """
+    words = [None] * len(vocab)
+    for w, i in vocab.items():
+        words[i] = w
+    word_keys = np.asarray([int.from_bytes(hashlib.blake2b(w.encode(), digest_size=8).digest(), 'little')
+                            for w in words], dtype=np.uint64)
+
+    keys = []
+    for k, table in enumerate(tables):
+        last_words = word_keys[table & NGRAM_ID_MASK]
+        if k == 0:
+            keys.append(last_words)
+        else:
+            keys.append((keys[k - 1][table >> NGRAM_ID_BITS] * np.uint64(NGRAM_KEY_PRIME)) ^ last_words)
+    return keys
+
+
+def bleu_from_stats(testlen, reflen, guess, correct):
+    """
+    BLEU-1..n from sentence or corpus statistics, as computed by BleuScorer
+    @param testlen: hypothesis length(s)
+    @param reflen: 'closest' reference length(s)
+    @param guess: (..., n) number of hypothesis n-grams of every order
+    @param correct: (..., n) number of clipped matching n-grams of every order
+    @return: (..., n) BLEU scores
+    """
+    small, tiny = 1e-9, 1e-15
+    bleu = np.cumprod((correct + tiny) / (guess + small), axis=-1)
+    bleu = bleu ** (1. / np.arange(1, bleu.shape[-1] + 1))
+    ratio = (testlen + tiny) / (reflen + small)
+    penalty = np.where(ratio < 1, np.exp(1 - 1 / np.minimum(ratio, 1)), 1.0)
+    return bleu * np.expand_dims(penalty, -1)
+
+
+class CaptionScorer:
+    """
+    Fast BLEU-1..4, ROUGE-L and CIDEr-D scorer over a fixed set of references.
+    Results match Bleu(4) (option 'closest'), Rouge() and Cider() of the coco-caption package.
+    """
+
+    def __init__(self, ref, n=4, sigma=6.0, hypo=None, doc_freq=None):
+        """
+
+        @param ref: dictionary of reference sentences (id, list of sentences)
+        @param n: max n-gram order
+        @param sigma: standard deviation of the CIDEr-D length penalty
+        @param hypo: (optional) dictionary of the hypotheses that will be scored, indexed with the references so
+                     that their n-grams are looked up in doc_freq too
+        @param doc_freq: (optional) (number of images, list over orders of (sorted n-gram keys, document
+                         frequencies)) of the whole corpus when ref is only a shard of it, see
+                         merge_document_frequencies. CIDEr then uses the document frequencies of the whole corpus
+        """
+        self.n = n
+        self.sigma = sigma
+        self.ids = list(ref.keys())
+        self.rouge_beta = 1.2
+
+        sentences = [r for key in self.ids for r in ref[key]]
+        self.ref_count = np.asarray([len(ref[key]) for key in self.ids], dtype=np.int64)
+        if (self.ref_count == 0).any():
+            raise ValueError("Every item needs at least one reference sentence")
+        self.ref_start = np.cumsum(self.ref_count) - self.ref_count
+        self.ref_image = np.repeat(np.arange(len(self.ids)), self.ref_count)
+        num_images, num_refs = len(self.ids), len(sentences)
+
+        hypo_sentences = [] if hypo is None else self._hypotheses(hypo)
+        self.vocab, self.tables, self.ref_lens, ref_counts, self.doc_freq = index_ngrams(sentences, self.ref_image,
+                                                                                         hypo_sentences, n)
+        corpus_size = num_images
+        if doc_freq is not None:
+            corpus_size, corpus_doc_freq = doc_freq
+            keys = get_ngram_keys(self.vocab, self.tables)
+            self.doc_freq = [lookup_sorted(corpus_keys, corpus_counts, keys[k]).astype(np.float64)
+                             for k, (corpus_keys, corpus_counts) in enumerate(corpus_doc_freq)]
+
+        # CIDEr uses the bigram count as the sentence length
+        self.ref_len = np.log(float(corpus_size))
+        self.ref_bigrams = np.maximum(self.ref_lens - 1, 0)
+
+        self.max_counts = []
+        self.ref_vec_keys = []
+        self.ref_vec = []
+        self.ref_norm = np.zeros((num_refs, n))
+        for k, (sent, gram, cnt) in enumerate(ref_counts):
+            # BLEU: max count of every n-gram over the references of an image
+            image_keys = (self.ref_image[sent] << NGRAM_ID_BITS) + gram
+            order = np.argsort(image_keys, kind='stable')
+            keys, first = np.unique(image_keys[order], return_index=True)
+            self.max_counts.append((keys, np.maximum.reduceat(cnt[order], first)))
+
+            # CIDEr: tf-idf vectors of the references
+            vec = cnt * (self.ref_len - np.log(np.maximum(1.0, self.doc_freq[k][gram])))
+            self.ref_vec_keys.append((sent << NGRAM_ID_BITS) + gram)
+            self.ref_vec.append(vec)
+            self.ref_norm[:, k] = np.sqrt(np.bincount(sent, vec ** 2, minlength=num_refs))
+
+        # ROUGE-L splits on single spaces
+        self.rouge_vocab = {}
+        rouge_words, self.rouge_ref_lens = tokenize_to_ids([s.split(" ") for s in sentences], self.rouge_vocab,
+                                                           grow=True)
+        self.rouge_refs = pad_token_ids(rouge_words, self.rouge_ref_lens, -1)
+
+    def _hypotheses(self, hypo):
+        if set(hypo.keys()) != set(self.ids):
+            raise ValueError("Hypotheses and references must have the same ids")
+        return [hypo[key][0] for key in self.ids]
+
+    def _bleu_stats(self, lens, counts):
+        num_images = len(self.ids)
+        guess = np.stack([np.maximum(0, lens - k) for k in range(self.n)], axis=1).astype(np.float64)
+        correct = np.zeros((num_images, self.n))
+        for k, (sent, gram, cnt) in enumerate(counts):
+            keys, max_counts = self.max_counts[k]
+            clipped = np.minimum(cnt, lookup_sorted(keys, max_counts, (sent << NGRAM_ID_BITS) + gram))
+            correct[:, k] = np.bincount(sent, clipped, minlength=num_images)
+
+        # 'closest' reference length, ties go to the shorter reference
+        distance = np.abs(self.ref_lens - lens[self.ref_image])
+        order = np.lexsort((self.ref_lens, distance, self.ref_image))
+        _, first = np.unique(self.ref_image[order], return_index=True)
+        reflen = self.ref_lens[order[first]].astype(np.float64)
+        return lens.astype(np.float64), reflen, guess, correct
+
+    def _cider(self, lens, counts):
+        num_images, num_refs = len(self.ids), self.ref_image.shape[0]
+        val = np.zeros((num_refs, self.n))
+        for k, (sent, gram, cnt) in enumerate(counts):
+            doc_freq = np.zeros(gram.max(initial=-1) + 1)
+            known = min(doc_freq.shape[0], self.doc_freq[k].shape[0])
+            doc_freq[:known] = self.doc_freq[k][:known]
+            vec = cnt * (self.ref_len - np.log(np.maximum(1.0, doc_freq[gram])))
+            norm = np.sqrt(np.bincount(sent, vec ** 2, minlength=num_images))
+
+            # pair every hypothesis n-gram with each reference of its image
+            repeats = self.ref_count[sent]
+            entry = np.repeat(np.arange(sent.shape[0]), repeats)
+            offset = np.arange(entry.shape[0]) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+            ref = self.ref_start[sent[entry]] + offset
+
+            matched = lookup_sorted(self.ref_vec_keys[k], self.ref_vec[k], (ref << NGRAM_ID_BITS) + gram[entry])
+            dot = np.bincount(ref, np.minimum(vec[entry], matched) * matched, minlength=num_refs)
+
+            norms = norm[self.ref_image] * self.ref_norm[:, k]
+            val[:, k] = np.where(norms != 0, dot / np.where(norms != 0, norms, 1.0), dot)
+
+        delta = (np.maximum(lens - 1, 0)[self.ref_image] - self.ref_bigrams).astype(np.float64)
+        val *= np.expand_dims(np.exp(-(delta ** 2) / (2 * self.sigma ** 2)), 1)
+        scores = np.bincount(self.ref_image, val.sum(axis=1), minlength=num_images)
+        return scores / self.n / self.ref_count * 10.0
+
+    def _rouge(self, hypotheses):
+        words, lens = tokenize_to_ids([h.split(" ") for h in hypotheses], self.rouge_vocab)
+        cands = pad_token_ids(words, lens, -2)[self.ref_image]
+        cand_lens = lens[self.ref_image]
+        lcs = batched_lcs(self.rouge_refs, cands, self.rouge_ref_lens, cand_lens)
+
+        prec = np.maximum.reduceat(lcs / cand_lens, self.ref_start)
+        rec = np.maximum.reduceat(lcs / self.rouge_ref_lens, self.ref_start)
+        beta2 = self.rouge_beta ** 2
+        valid = (prec != 0) & (rec != 0)
+        return np.where(valid, ((1 + beta2) * prec * rec) / np.where(valid, rec + beta2 * prec, 1.0), 0.0)
+
+    def compute_sentence_scores(self, hypo):
+        """
+        hypo, dictionary of hypothesis sentences (id, sentence)
+        @return: tuple of the corpus-level BLEU statistics and a dictionary of metric name -> per-sentence scores,
+                 in the order of the reference ids
+        """
+        hypotheses = self._hypotheses(hypo)
+        words, lens = tokenize_to_ids([h.split() for h in hypotheses], self.vocab)
+        counts = get_ngram_counts(words, lens, self.tables, self.n)
+
+        testlen, reflen, guess, correct = self._bleu_stats(lens, counts)
+        bleu = bleu_from_stats(testlen, reflen, guess, correct)
+
+        sentence_scores = {"Bleu_%d" % (k + 1): bleu[:, k] for k in range(self.n)}
+        sentence_scores["ROUGE_L"] = self._rouge(hypotheses)
+        sentence_scores["CIDEr"] = self._cider(lens, counts)
+        bleu_stats = (testlen.sum(), reflen.sum(), guess.sum(axis=0), correct.sum(axis=0))
+        return bleu_stats, sentence_scores
+
+    def compute_score(self, hypo):
+        """
+        hypo, dictionary of hypothesis sentences (id, sentence)
+        @return: dictionary of corpus-level scores, with the same keys as score() except METEOR
+        """
+        bleu_stats, sentence_scores = self.compute_sentence_scores(hypo)
+        corpus_bleu = bleu_from_stats(*bleu_stats)
+
+        final_scores = {"Bleu_%d" % (k + 1): float(corpus_bleu[k]) for k in range(self.n)}
+        final_scores["ROUGE_L"] = float(np.mean(sentence_scores["ROUGE_L"]))
+        final_scores["CIDEr"] = float(np.mean(sentence_scores["CIDEr"]))
+        return final_scores
+
+
+def fast_score(ref, hypo):
+    """
+    Same as score() without METEOR, using the built-in CaptionScorer
+
+    ref, dictionary of reference sentences (id, sentence)
+    hypo, dictionary of hypothesis sentences (id, sentence)
+    score, dictionary of scores
+    """
+    return CaptionScorer(ref).compute_score(hypo)
+
+
+def shard_document_frequencies(ref, hypo, n=4):
+    """
+    Worker of parallel_score: document frequencies of the n-grams of the references and hypotheses of one shard
+    @return: list over orders of (n-gram keys, number of images of the shard whose references contain the n-gram)
+    """
+    ids = list(ref.keys())
+    sentences = [r for key in ids for r in ref[key]]
+    ref_image = np.repeat(np.arange(len(ids)), [len(ref[key]) for key in ids])
+    vocab, tables, _, _, doc_freq = index_ngrams(sentences, ref_image, [hypo[key][0] for key in ids], n)
+    return list(zip(get_ngram_keys(vocab, tables), doc_freq))
+
+
+def merge_document_frequencies(shard_doc_freqs):
+    """
+    Sum the document frequencies of the shards, the shards hold different images
+    @param shard_doc_freqs: list over shards of the shard_document_frequencies
+    @return: list over shards of their n-gram keys, sorted, with their document frequencies over all the shards
+    """
+    merged = [[] for _ in shard_doc_freqs]
+    for k in range(len(shard_doc_freqs[0])):
+        keys = np.concatenate([doc_freq[k][0] for doc_freq in shard_doc_freqs])
+        counts = np.concatenate([doc_freq[k][1] for doc_freq in shard_doc_freqs])
+        corpus_keys, inverse = np.unique(keys, return_inverse=True)
+        corpus_counts = np.bincount(inverse.reshape(-1), counts, minlength=corpus_keys.shape[0])
+        for shard, doc_freq in enumerate(shard_doc_freqs):
+            shard_keys = np.sort(doc_freq[k][0])
+            merged[shard].append((shard_keys, lookup_sorted(corpus_keys, corpus_counts, shard_keys)))
+    return merged
+
+
+def score_shard(ref, hypo, doc_freq=None):
+    """
+    Worker of parallel_score: BLEU statistics and per-sentence ROUGE-L and CIDEr of one shard
+    @param doc_freq: (optional) (number of images, document frequencies) of the whole corpus, see CaptionScorer
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return CaptionScorer(ref, hypo=hypo, doc_freq=doc_freq).compute_sentence_scores(hypo)
+
+
+def score_meteor(ref, hypo):
+    """
+    Worker of parallel_score: corpus METEOR. The Java scorer aggregates its own statistics, so it gets all the data.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        meteor_score, _ = Meteor().compute_score(ref, hypo)
+    return meteor_score
+
+
+def parallel_score(ref, hypo, workers=None, meteor=True):
+    """
+    Same scores as score(), computed by a pool of processes. METEOR runs as one task while the other metrics
+    are split in shards. The CIDEr document frequencies of every shard are counted first and summed, then every
+    shard is scored with the document frequencies of the whole corpus, and the shards' BLEU counts are summed
+    before the corpus scores are computed. Scorer output stays in the worker processes.
+
+    ref, dictionary of reference sentences (id, sentence)
+    hypo, dictionary of hypothesis sentences (id, sentence)
+    workers, number of processes, None for one per core
+    meteor, whether to compute METEOR too (it needs java)
+    score, dictionary of scores
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    ids = list(ref.keys())
+    shards = [shard for shard in np.array_split(np.arange(len(ids)), workers) if shard.shape[0] > 0]
+    shard_args = []
+    for shard in shards:
+        shard_ids = [ids[i] for i in shard]
+        shard_args.append(({i: ref[i] for i in shard_ids}, {i: hypo[i] for i in shard_ids}))
+
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        if meteor:
+            meteor_result = pool.apply_async(score_meteor, (ref, hypo))
+        doc_freqs = merge_document_frequencies(pool.starmap(shard_document_frequencies, shard_args))
+        results = pool.starmap(score_shard, [(shard_ref, shard_hypo, (len(ids), doc_freq))
+                                             for (shard_ref, shard_hypo), doc_freq in zip(shard_args, doc_freqs)])
+        if meteor:
+            meteor_score = meteor_result.get()
+
+    testlen = sum(bleu_stats[0] for bleu_stats, _ in results)
+    reflen = sum(bleu_stats[1] for bleu_stats, _ in results)
+    guess = np.sum([bleu_stats[2] for bleu_stats, _ in results], axis=0)
+    correct = np.sum([bleu_stats[3] for bleu_stats, _ in results], axis=0)
+    corpus_bleu = bleu_from_stats(testlen, reflen, guess, correct)
+
+    final_scores = {"Bleu_%d" % (k + 1): float(corpus_bleu[k]) for k in range(corpus_bleu.shape[0])}
+    if meteor:
+        final_scores["METEOR"] = meteor_score
+    for method in ["ROUGE_L", "CIDEr"]:
+        final_scores[method] = float(np.mean(np.concatenate([scores[method] for _, scores in results])))
+    return final_scores
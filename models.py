@@ -12,6 +12,7 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
 import numpy as np
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -30,6 +31,51 @@ def repackage_hidden(h):
         return tuple(repackage_hidden(v) for v in h)
 
 
+def run_caption_rnn(rnn, caption_embedding, captions, lengths=None):
+    """
+    Embed a batch of captions and run them through a batch-first recurrent layer in a single call.
+    @param rnn: the batch-first LSTM/GRU to run
+    @param caption_embedding: the embedding layer for the caption tokens
+    @param captions: (N, T) tensor of tokens, or a PackedSequence of tokens
+    @param lengths: (optional) valid length of every caption, padding after it is ignored
+    @return: tuple of the padded per-timestep outputs (N, T, D) and the lengths (N,) of the captions
+    """
+    if isinstance(captions, PackedSequence):
+        input_captions = PackedSequence(caption_embedding(captions.data), captions.batch_sizes,
+                                        captions.sorted_indices, captions.unsorted_indices)
+        output, _ = rnn(input_captions)
+        return pad_packed_sequence(output, batch_first=True)
+
+    input_captions = caption_embedding(captions)
+    if lengths is None:
+        output, _ = rnn(input_captions)
+        lengths = torch.full((captions.shape[0],), captions.shape[1], dtype=torch.long)
+        return output, lengths
+
+    lengths = torch.as_tensor(lengths).long().cpu()
+    packed = pack_padded_sequence(input_captions, lengths, batch_first=True, enforce_sorted=False)
+    output, _ = rnn(packed)
+    output, _ = pad_packed_sequence(output, batch_first=True, total_length=captions.shape[1])
+    return output, lengths
+
+
+def gather_last_output(output, lengths, bidirectional=False):
+    """
+    Pick the output of the last valid timestep of every sequence. For a bidirectional layer, the backward half
+    is taken at the first timestep instead, where the backward direction has read the whole sequence
+    @param output: (N, T, D) padded per-timestep outputs
+    @param lengths: (N,) valid lengths of the sequences
+    @param bidirectional: whether the outputs are the concatenated forward and backward outputs
+    @return: (N, D) tensor
+    """
+    index = (lengths.to(output.device) - 1).view(-1, 1, 1).expand(-1, 1, output.shape[2])
+    last_output = output.gather(1, index).squeeze(1)
+    if bidirectional:
+        hidden_dim = output.shape[2] // 2
+        last_output = torch.cat((last_output[:, :hidden_dim], output[:, 0, hidden_dim:]), dim=1)
+    return last_output
+
+
 class PolicyNetwork(nn.Module):
     """
     This is the Policy Network class. Works as an actor of the system.
@@ -68,16 +114,44 @@ class PolicyNetwork(nn.Module):
         self.lstm = nn.LSTM(wordvec_dim, hidden_dim, batch_first=True, bidirectional=self.bidirectional)
         self.linear2vocab = nn.Linear(hidden_dim * num_dim, vocab_size)
 
-    def forward(self, features, captions):
-
-        input_captions = self.caption_embedding(captions)
+    def init_state(self, features):
+        """
+        Project the image features into the initial LSTM state
+        @param features: image features, either (1, N, input_dim) or (N, input_dim)
+        @return: tuple (h, c) of the initial hidden and cell states
+        """
+        if features.dim() == 2:
+            features = features.unsqueeze(0)
 
         hidden_init = self.cnn2linear(features)
         if self.bidirectional:
             hidden_init = torch.cat(torch.split(hidden_init, int(hidden_init.shape[-1]/2), dim=-1), dim=0)
         cell_init = torch.zeros_like(hidden_init)
 
-        output, _ = self.lstm(input_captions, (hidden_init, cell_init))
+        return hidden_init, cell_init
+
+    def step(self, prev_tokens, state):
+        """
+        Incremental decoding: advance the LSTM by a single token, reusing the state of the previous step
+        @param prev_tokens: last generated tokens of shape (N,) or (N, 1)
+        @param state: tuple (h, c) from init_state() or from the previous call to step()
+        @return: tuple of next-word logits (N, vocab_size) and the new (h, c) state
+        """
+        if self.bidirectional:
+            # the backward direction depends on the whole sequence, so it can't be decoded incrementally
+            raise ValueError("Incremental decoding is only supported for unidirectional policy networks")
+
+        input_captions = self.caption_embedding(prev_tokens.view(-1, 1))
+        output, state = self.lstm(input_captions, state)
+        output = self.linear2vocab(output[:, -1])
+
+        return output, state
+
+    def forward(self, features, captions):
+
+        input_captions = self.caption_embedding(captions)
+
+        output, _ = self.lstm(input_captions, self.init_state(features))
 
         output = self.linear2vocab(output)
 
@@ -116,23 +190,15 @@ class ValueNetworkRNN(nn.Module):
         else:
             self.caption_embedding = nn.Embedding(vocab_size, wordvec_dim)
 
-        self.init_hidden()
-        self.lstm = nn.LSTM(wordvec_dim, hidden_dim, bidirectional=self.bidirectional)
-
-    def init_hidden(self):
-        if self.bidirectional:
-            self.hidden_cell = (
-                torch.zeros(2, 1, self.hidden_dim).to(device), torch.zeros(2, 1, self.hidden_dim).to(device))
-        else:
-            self.hidden_cell = (
-                torch.zeros(1, 1, self.hidden_dim).to(device), torch.zeros(1, 1, self.hidden_dim).to(device))
-
-    def forward(self, captions):
-
-        input_captions = self.caption_embedding(captions)
-        output, self.hidden_cell = self.lstm(input_captions.view(len(input_captions), 1, -1), self.hidden_cell)
+        self.lstm = nn.LSTM(wordvec_dim, hidden_dim, batch_first=True, bidirectional=self.bidirectional)
 
-        return output
+    def forward(self, captions, lengths=None):
+        """
+        @param captions: (N, T) tensor of tokens, or a PackedSequence of tokens
+        @param lengths: (optional) valid length of every caption
+        @return: tuple of the per-timestep outputs (N, T, D) and the caption lengths (N,)
+        """
+        return run_caption_rnn(self.lstm, self.caption_embedding, captions, lengths)
 
 
 class ValueNetwork(nn.Module):
@@ -163,14 +229,12 @@ class ValueNetwork(nn.Module):
         if self.bidirectional:
             self.rnn_linear = nn.Linear(1024, 512)
 
-    def forward(self, features, captions):
+    def forward(self, features, captions, lengths=None):
 
-        for t in range(captions.shape[1]):
-            value_rnn_output = self.valrnn(captions[:, t])
+        value_rnn_output = gather_last_output(*self.valrnn(captions, lengths), self.bidirectional)
 
         if self.bidirectional:
             value_rnn_output = self.rnn_linear(value_rnn_output)
-        value_rnn_output = value_rnn_output.squeeze(0).squeeze(1)
 
         state = torch.cat((features, value_rnn_output), dim=1)
 
@@ -211,21 +275,15 @@ class RewardNetworkRNN(nn.Module):
         else:
             self.caption_embedding = nn.Embedding(vocab_size, wordvec_dim)
 
-        self.init_hidden()
-        self.gru = nn.GRU(wordvec_dim, hidden_dim, bidirectional=self.bidirectional)
-
-    def init_hidden(self):
-        if self.bidirectional:
-            self.hidden_cell = torch.zeros(2, 1, self.hidden_dim).to(device)
-        else:
-            self.hidden_cell = torch.zeros(1, 1, self.hidden_dim).to(device)
-
-    def forward(self, captions):
+        self.gru = nn.GRU(wordvec_dim, hidden_dim, batch_first=True, bidirectional=self.bidirectional)
 
-        input_captions = self.caption_embedding(captions)
-        output, self.hidden_cell = self.gru(input_captions.view(len(input_captions), 1, -1), self.hidden_cell)
-
-        return output
+    def forward(self, captions, lengths=None):
+        """
+        @param captions: (N, T) tensor of tokens, or a PackedSequence of tokens
+        @param lengths: (optional) valid length of every caption
+        @return: tuple of the per-timestep outputs (N, T, D) and the caption lengths (N,)
+        """
+        return run_caption_rnn(self.gru, self.caption_embedding, captions, lengths)
 
 
 class RewardNetwork(nn.Module):
@@ -250,12 +308,26 @@ class RewardNetwork(nn.Module):
         self.visual_embed = nn.Linear(512, 512)
         self.semantic_embed = nn.Linear(rnn_out_dim, 512)
 
-    def forward(self, features, captions):
-        for t in range(captions.shape[1]):
-            reward_rnn_output = self.rewrnn(captions[:, t])
+    def forward(self, features, captions, lengths=None):
+        reward_rnn_output = gather_last_output(*self.rewrnn(captions, lengths), self.bidirectional)
+
+        se = self.semantic_embed(reward_rnn_output)
+        ve = self.visual_embed(features)
 
-        reward_rnn_output = reward_rnn_output.squeeze(0).squeeze(1)
+        return ve, se
 
+    def prefix_embeddings(self, features, captions):
+        """
+        Semantic embeddings of every prefix of the captions, read from a single pass of the GRU.
+        Only for unidirectional networks, where the output of timestep t only depends on the first t + 1 words.
+        @param features: (N, input_dim) image features
+        @param captions: (N, T) tensor of tokens
+        @return: tuple of the visual embeddings (N, 512) and the semantic embeddings (N, T, 512) of the
+        prefixes captions[:, :t + 1]
+        """
+        if self.bidirectional:
+            raise ValueError("prefix embeddings need a unidirectional reward network")
+        reward_rnn_output, _ = self.rewrnn(captions)
         se = self.semantic_embed(reward_rnn_output)
         ve = self.visual_embed(features)
 
@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from PIL import Image
+from utilities import ImageFetcher
+
+
+def make_image_bytes():
+    buffer = BytesIO()
+    Image.new('RGB', (4, 4), color=(255, 0, 0)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+IMAGE_BYTES = make_image_bytes()
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """
+    /image.png always succeeds, /flaky.png fails with a 503 on its first request, /missing.png is a 404
+    """
+    requests_per_path = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            count = self.requests_per_path.get(self.path, 0) + 1
+            self.requests_per_path[self.path] = count
+
+        if self.path == '/image.png' or (self.path == '/flaky.png' and count > 1):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(IMAGE_BYTES)))
+            self.end_headers()
+            self.wfile.write(IMAGE_BYTES)
+        else:
+            self.send_response(503 if self.path == '/flaky.png' else 404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageFetcherTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+        cls.base_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        ImageHandler.requests_per_path.clear()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.fetcher = ImageFetcher(self.cache_dir.name, max_workers=2, retries=2, backoff=0.01, timeout=5)
+
+    def tearDown(self):
+        self.fetcher.session.close()
+        self.cache_dir.cleanup()
+
+    def test_fetch(self):
+        path = self.fetcher.fetch(self.base_url + '/image.png')
+        self.assertEqual(path, self.fetcher.cache_path(self.base_url + '/image.png'))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), IMAGE_BYTES)
+        self.assertEqual(self.fetcher.open(self.base_url + '/image.png').size, (4, 4))
+
+    def test_retry_then_success(self):
+        path = self.fetcher.fetch(self.base_url + '/flaky.png')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), IMAGE_BYTES)
+        self.assertEqual(ImageHandler.requests_per_path['/flaky.png'], 2)
+
+    def test_not_found(self):
+        with self.assertRaises(requests.HTTPError):
+            self.fetcher.fetch(self.base_url + '/missing.png')
+        # client errors are not retried
+        self.assertEqual(ImageHandler.requests_per_path['/missing.png'], 1)
+        self.assertFalse(os.path.exists(self.fetcher.cache_path(self.base_url + '/missing.png')))
+        self.assertEqual(self.fetcher.fetch_all([self.base_url + '/missing.png', self.base_url + '/image.png']),
+                         [None, self.fetcher.cache_path(self.base_url + '/image.png')])
+
+    def test_cache_hit(self):
+        first = self.fetcher.fetch(self.base_url + '/image.png')
+        second = self.fetcher.fetch(self.base_url + '/image.png ')
+        self.assertEqual(first, second)
+        self.assertEqual(ImageHandler.requests_per_path['/image.png'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from metrics import score, fast_score, parallel_score
+
+WORDS = ['a', 'man', 'woman', 'dog', 'cat', 'riding', 'sitting', 'on', 'in', 'the', 'street', 'horse', 'bike',
+         'with', 'red', 'blue', 'table', 'next', 'to', 'and', 'of', 'group', 'people', 'standing', 'grass']
+METHODS = ['Bleu_1', 'Bleu_2', 'Bleu_3', 'Bleu_4', 'ROUGE_L', 'CIDEr']
+
+
+def make_captions(num_images, num_refs, seed=0):
+    """
+    random captions, the hypotheses share words and n-grams with their references
+    """
+    rng = np.random.RandomState(seed)
+    refs, hypo = {}, {}
+    for i in range(num_images):
+        refs[i] = [' '.join(rng.choice(WORDS, rng.randint(3, 15))) for _ in range(num_refs)]
+        words = refs[i][0].split()
+        start = rng.randint(len(words))
+        hypo[i] = [' '.join(words[start:] + list(rng.choice(WORDS, rng.randint(1, 6))))]
+    return refs, hypo
+
+
+class FastScoreTest(unittest.TestCase):
+
+    def assertScoresEqual(self, expected, actual):
+        for method in METHODS:
+            self.assertAlmostEqual(expected[method], actual[method], delta=1e-6, msg=method)
+
+    def test_single_reference(self):
+        refs, hypo = make_captions(200, 1)
+        self.assertScoresEqual(score(refs, hypo, meteor=False), fast_score(refs, hypo))
+
+    def test_multiple_references(self):
+        refs, hypo = make_captions(200, 5, seed=1)
+        self.assertScoresEqual(score(refs, hypo, meteor=False), fast_score(refs, hypo))
+
+    def test_fixed_captions(self):
+        refs = {0: ['a man riding a horse on the street', 'a person on a horse'],
+                1: ['a cat sitting on a table'],
+                2: ['two dogs playing in the grass', 'dogs in the grass', 'a dog running']}
+        hypo = {0: ['a man riding a horse'], 1: ['a cat on a table'], 2: ['a dog in the grass']}
+        self.assertScoresEqual(score(refs, hypo, meteor=False), fast_score(refs, hypo))
+
+    def test_parallel_score(self):
+        refs, hypo = make_captions(300, 5, seed=2)
+        expected = score(refs, hypo, meteor=False)
+        actual = parallel_score(refs, hypo, workers=3, meteor=False)
+        self.assertNotIn('METEOR', actual)
+        self.assertScoresEqual(expected, actual)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.nn import functional as F
+import torch.optim as optim
+from benchmarks import make_synthetic_coco
+from trainers import GenerateCaptionsWithActorCriticLookAhead, GetPrefixRewards, GetRewards, PolicyNetwork, \
+    RewardNetwork, ValueNetwork, AdvantageActorCriticNetwork, ActionSampler, a2c_training, MAX_SEQ_LEN, device
+
+VOCAB_SIZE = 40
+
+
+def make_word_to_idx():
+    words = ['<NULL>', '<START>', '<END>', '<UNK>'] + ['w%d' % i for i in range(VOCAB_SIZE - 4)]
+    return {w: i for i, w in enumerate(words)}
+
+
+def reference_beam_search(features, captions, policy_network, value_network, beamSize):
+    """
+    beam search over one image at a time, every candidate scored on its own with full forward passes
+    """
+    results = []
+    for n in range(features.shape[0]):
+        image_features = features[n:n + 1]
+        candidates = [(captions[n:n + 1, 0:1], 0.0)]
+        for t in range(MAX_SEQ_LEN - 1):
+            next_candidates = []
+            for caption, score in candidates:
+                output = policy_network(image_features.unsqueeze(0), caption)[:, -1, :]
+                log_probs, words = torch.topk(F.log_softmax(output, dim=1), beamSize)
+                for i in range(beamSize):
+                    expansion = torch.cat((caption, words[:, i:i + 1]), dim=1)
+                    value = value_network(image_features, expansion).item()
+                    next_candidates.append((expansion, score - (0.6 * value + 0.4 * log_probs[0, i].item())))
+            candidates = sorted(next_candidates, key=lambda candidate: candidate[1])[:beamSize]
+        results.append(candidates)
+    return results
+
+
+class BeamSearchTest(unittest.TestCase):
+
+    def test_matches_reference(self):
+        self.check_beam_search(bidirectional=False)
+
+    def test_matches_reference_bidirectional(self):
+        self.check_beam_search(bidirectional=True)
+
+    def check_beam_search(self, bidirectional):
+        torch.manual_seed(0)
+        word_to_idx = make_word_to_idx()
+        policy_network = PolicyNetwork(word_to_idx, bidirectional=bidirectional).to(device).eval()
+        value_network = ValueNetwork(word_to_idx, bidirectional=bidirectional).to(device).eval()
+        features = torch.randn(3, 512, device=device)
+        captions = torch.ones((3, MAX_SEQ_LEN), dtype=torch.long, device=device)
+        beamSize = 3
+
+        with torch.no_grad():
+            beams = GenerateCaptionsWithActorCriticLookAhead(features, captions, policy_network, value_network,
+                                                             beamSize=beamSize)
+            expected = reference_beam_search(features, captions, policy_network, value_network, beamSize)
+
+        self.assertEqual(len(beams), beamSize)
+        for i, (caption, score) in enumerate(beams):
+            self.assertEqual(tuple(caption.shape), (3, MAX_SEQ_LEN))
+            for n in range(3):
+                expected_caption, expected_score = expected[n][i]
+                self.assertTrue(torch.equal(caption[n], expected_caption[0]))
+                self.assertAlmostEqual(score[n, 0].item(), expected_score, delta=1e-4)
+
+        with torch.no_grad():
+            best = GenerateCaptionsWithActorCriticLookAhead(features, captions, policy_network, value_network,
+                                                            beamSize=beamSize, most_likely=True)
+        self.assertTrue(torch.equal(best, beams[0][0]))
+
+
+class PrefixRewardsTest(unittest.TestCase):
+
+    def check_prefix_rewards(self, bidirectional, start):
+        torch.manual_seed(0)
+        reward_network = RewardNetwork(make_word_to_idx(), bidirectional=bidirectional).to(device).eval()
+        features = torch.randn(4, 512, device=device)
+        captions = torch.randint(0, VOCAB_SIZE, (4, MAX_SEQ_LEN), device=device)
+
+        with torch.no_grad():
+            rewards = GetPrefixRewards(features, captions, reward_network, start=start)
+            expected = torch.cat([GetRewards(features, captions[:, :t + 1], reward_network)
+                                  for t in range(start, MAX_SEQ_LEN)], dim=1)
+        self.assertEqual(tuple(rewards.shape), (4, MAX_SEQ_LEN - start))
+        self.assertTrue(torch.allclose(rewards, expected, atol=1e-6))
+
+    def test_matches_per_prefix_rewards(self):
+        self.check_prefix_rewards(bidirectional=False, start=1)
+        self.check_prefix_rewards(bidirectional=False, start=9)
+
+    def test_matches_per_prefix_rewards_bidirectional(self):
+        self.check_prefix_rewards(bidirectional=True, start=1)
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = make_synthetic_coco(num_train=48, num_val=8, num_images=16, vocab_size=VOCAB_SIZE)
+        self.log_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def train(self, tag, epochs, resume_state=None):
+        """
+        seeded A2C training, resumed from resume_state like train_a2c_network does
+        @return: the trained network and the path of its last training state
+        """
+        torch.manual_seed(0)
+        reward_network = RewardNetwork(self.data["word_to_idx"]).to(device)
+        reward_network.requires_grad_(False)
+        a2c_network = AdvantageActorCriticNetwork(ValueNetwork(self.data["word_to_idx"]),
+                                                  PolicyNetwork(self.data["word_to_idx"])).to(device)
+        optimizer = optim.Adam(a2c_network.parameters(), lr=0.0001)
+        if resume_state is not None:
+            a2c_network.load_state_dict(resume_state["model"])
+            optimizer.load_state_dict(resume_state["optimizer"])
+
+        resume_path = os.path.join(self.log_dir.name, tag + '-state.pt')
+        a2c_training(self.data, a2c_network, reward_network, optimizer, os.path.join(self.log_dir.name, 'runs'),
+                     [os.path.join(self.log_dir.name, tag + '.pt')], batch_size=16, epochs=epochs,
+                     sampler=ActionSampler(seed=1), resume_state=resume_state, resume_path=resume_path)
+        return a2c_network, resume_path
+
+    def test_resume_matches_uninterrupted_training(self):
+        expected, _ = self.train('full', epochs=2)
+        _, resume_path = self.train('interrupted', epochs=1)
+        resumed, _ = self.train('resumed', epochs=2,
+                                resume_state=torch.load(resume_path, map_location='cpu', weights_only=False))
+
+        for (name, p), q in zip(expected.state_dict().items(), resumed.state_dict().values()):
+            self.assertTrue(torch.equal(p, q), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
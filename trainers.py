@@ -12,6 +12,9 @@
 import time
 import random
 import math
+import socket
+import copy
+import contextlib
 import torch.optim as optim
 from tqdm import tqdm
 from utilities import *
@@ -54,6 +57,22 @@ def VisualSemanticEmbeddingLoss(visuals, semantics):
     return visloss + semloss
 
 
+def MaskedCaptionLoss(output, targets, lengths):
+    """
+
+    @param output: (N, T, vocab_size) next word scores from the policy network
+    @param targets: (N, T) expected next words
+    @param lengths: (N,) caption lengths, only the first lengths[i] words of caption i are scored
+    @return: cross entropy summed over the valid words of each caption, averaged over the batch
+
+    Single-call equivalent of weighting the mean cross entropy of every caption by caplen / N.
+    """
+    N, T = targets.shape
+    losses = F.cross_entropy(output.reshape(N * T, -1), targets.reshape(-1), reduction='none').view(N, T)
+    mask = torch.arange(T, device=targets.device).unsqueeze(0) < lengths.view(-1, 1)
+    return (losses * mask).sum() / N
+
+
 def GenerateCaptionsGreedy(features, captions, policy_network):
     """
 
@@ -62,17 +81,33 @@ def GenerateCaptionsGreedy(features, captions, policy_network):
     @param policy_network: network that decides on the next word
     @return: potential caption based on short-term greedy decision making
     """
-    features = torch.tensor(features, device=device).float().unsqueeze(0)
-    gen_caps = torch.tensor(captions[:, 0:1], device=device).long()
+    features = torch.as_tensor(features, device=device).float().unsqueeze(0)
+    gen_caps = torch.as_tensor(captions[:, 0:1], device=device).long()
+
+    if policy_network.bidirectional:
+        # bidirectional nets have to re-read the whole prefix at every step
+        for t in range(MAX_SEQ_LEN - 1):
+            output = policy_network(features, gen_caps)
+            gen_caps = torch.cat((gen_caps, output[:, -1:, :].argmax(axis=2)), axis=1)
+        return gen_caps
+
+    # carry the LSTM state forward so that each new word costs a single LSTM step
+    state = policy_network.init_state(features)
+    words = gen_caps[:, 0]
+    generated = [gen_caps]
     for t in range(MAX_SEQ_LEN - 1):
-        output = policy_network(features, gen_caps)
-        gen_caps = torch.cat((gen_caps, output[:, -1:, :].argmax(axis=2)), axis=1)
-    return gen_caps
+        output, state = policy_network.step(words, state)
+        words = output.argmax(axis=1)
+        generated.append(words.unsqueeze(1))
+    return torch.cat(generated, axis=1)
 
 
 def GenerateCaptionsWithActorCriticLookAhead(features, captions, policy_network, value_network, beamSize=5,
                                              most_likely=False):
     """
+    Batched beam search. The beams of every image are kept in one (N * beamSize, T) tensor, each step scores all
+    the expansions with a single policy call and a single value call, and the best beamSize expansions are picked
+    per image with torch.topk.
 
     @param features: image features
     @param captions: image caption
@@ -82,27 +117,50 @@ def GenerateCaptionsWithActorCriticLookAhead(features, captions, policy_network,
     @param most_likely: flag - whether to return the single most likely caption
     @return: list of potential captions
     """
-    features = torch.tensor(features, device=device).float().unsqueeze(0)
-    gen_caps = torch.tensor(captions[:, 0:1], device=device).long()
+    features = torch.as_tensor(features, device=device).float()
+    gen_caps = torch.as_tensor(captions[:, 0:1], device=device).long()
+    N = features.shape[0]
 
-    candidates = [(gen_caps, 0)]
-    for t in range(MAX_SEQ_LEN - 1):
-        next_candidates = []
-        for c in range(len(candidates)):
-            output = policy_network(features, candidates[c][0])
-            probs, words = torch.topk(output[:, -1:, :], beamSize)
-            for i in range(beamSize):
-                cap = torch.cat((candidates[c][0], words[:, :, i]), axis=1)
-                value = value_network(features.squeeze(0), cap).detach()
-                score_delta = 0.6 * value + 0.4 * torch.log(probs[:, :, i])
-                score = candidates[c][1] - score_delta
-                next_candidates.append((cap, score))
-        ordered_candidates = sorted(next_candidates, key=lambda tup: tup[1].mean())
-        candidates = ordered_candidates[:beamSize]
+    # beams of image n are stored in rows n * num_beams ... (n + 1) * num_beams - 1
+    num_beams = 1
+    beams = gen_caps
+    beam_features = features
+    scores = torch.zeros((N, 1), device=device)
 
+    incremental = not policy_network.bidirectional
+    if incremental:
+        state = policy_network.init_state(features)
+
+    for t in range(MAX_SEQ_LEN - 1):
+        if incremental:
+            output, state = policy_network.step(beams[:, -1], state)
+        else:
+            output = policy_network(beam_features.unsqueeze(0), beams)[:, -1, :]
+        log_probs, words = torch.topk(F.log_softmax(output, dim=1), beamSize)
+
+        # every beam expanded with its beamSize most likely words: (N * num_beams * beamSize, t + 2)
+        expansions = torch.cat((beams.repeat_interleave(beamSize, dim=0), words.view(-1, 1)), dim=1)
+        values = value_network(beam_features.repeat_interleave(beamSize, dim=0), expansions).detach()
+
+        score_delta = 0.6 * values.view(N, -1) + 0.4 * log_probs.view(N, -1)
+        expansion_scores = scores.repeat_interleave(beamSize, dim=1) - score_delta
+
+        # lower scores are better, keep the best beamSize expansions of each image
+        scores, best = torch.topk(expansion_scores, beamSize, dim=1, largest=False)
+        rows = (best + torch.arange(N, device=device).unsqueeze(1) * num_beams * beamSize).view(-1)
+
+        beams = expansions[rows]
+        if incremental:
+            parents = rows // beamSize
+            state = tuple(s[:, parents] for s in state)
+        if num_beams != beamSize:
+            num_beams = beamSize
+            beam_features = features.repeat_interleave(beamSize, dim=0)
+
+    beams = beams.view(N, num_beams, -1)
     if most_likely == True:
-        return candidates[0][0]
-    return candidates
+        return beams[:, 0]
+    return [(beams[:, i], scores[:, i:i + 1]) for i in range(num_beams)]
 
 
 def GetRewards(features, captions, reward_network):
@@ -121,8 +179,359 @@ def GetRewards(features, captions, reward_network):
     return rewards
 
 
+def GetPrefixRewards(features, captions, reward_network, start=1):
+    """
+    Rewards of the prefixes captions[:, :t + 1] for t = start ... T - 1, equal within float tolerance to calling
+    GetRewards on every prefix. A unidirectional reward network reads them from one pass over the whole captions,
+    a bidirectional one has to re-read every prefix.
+
+    @param features: image features
+    @param captions: (N, T) image captions
+    @param reward_network: network that projects captions and images onto a common vector space
+    @param start: index of the last word of the first rewarded prefix
+    @return: (N, T - start) similarities between the embedded projections of the prefixes and images
+    """
+    if reward_network.bidirectional:
+        return torch.cat([GetRewards(features, captions[:, :t + 1], reward_network)
+                          for t in range(start, captions.shape[1])], dim=1)
+
+    visEmbeds, semEmbeds = reward_network.prefix_embeddings(features, captions)
+    visEmbeds = F.normalize(visEmbeds, p=2, dim=1)
+    semEmbeds = F.normalize(semEmbeds[:, start:], p=2, dim=2)
+
+    return torch.sum(visEmbeds.unsqueeze(1) * semEmbeds, axis=2)
+
+
+class ActionSampler:
+    """
+    Samples the next word of every rollout in the batch directly on the device,
+    so rollouts never have to copy the policy distribution to the host.
+    The policy gradient must use log_prob(), the log-probabilities of the tempered and truncated distribution
+    the words were sampled from, so that the actor loss stays on-policy.
+    """
+
+    def __init__(self, temperature=1.0, top_k=0, seed=None):
+        """
+
+        @param temperature: softmax temperature applied to the policy logits before sampling
+        @param top_k: (optional) only sample among the top_k most likely words, 0 to sample from the full vocabulary
+        @param seed: (optional) seed of the sampler's own random generator, for reproducible rollouts
+        """
+        self.temperature = temperature
+        self.top_k = top_k
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(seed)
+
+    def __call__(self, logits):
+        """
+
+        @param logits: (N, vocab_size) policy network outputs for the next word
+        @return: (N,) tensor of sampled words
+        """
+        logits = logits.detach().float() / self.temperature
+        if self.top_k > 0:
+            logits, words = torch.topk(logits, self.top_k, dim=1)
+            choice = torch.multinomial(F.softmax(logits, dim=1), 1, generator=self.generator)
+            return words.gather(1, choice).squeeze(1)
+        return torch.multinomial(F.softmax(logits, dim=1), 1, generator=self.generator).squeeze(1)
+
+    def log_prob(self, logits, actions):
+        """
+
+        @param logits: (N, vocab_size) policy network outputs for the next word
+        @param actions: (N,) words sampled from these logits
+        @return: (N, 1) log-probabilities of the words under the distribution they were sampled from
+        """
+        logits = logits / self.temperature
+        if self.top_k > 0:
+            # the sampled words are always among the top_k, the others get no probability
+            kth_logit = torch.topk(logits, self.top_k, dim=1).values[:, -1:]
+            logits = logits.masked_fill(logits < kth_logit, float('-inf'))
+        return F.log_softmax(logits, dim=1).gather(1, actions.unsqueeze(-1))
+
+
+class MixedPrecision:
+    """
+    Opt-in autocast for the forward passes of the networks. Runs in bfloat16 on CPU (and on GPUs that support it),
+    float16 otherwise. float16 gradients can underflow, so its losses are scaled before the backward pass.
+    Disabled, every method falls through to plain float32 training.
+    """
+
+    def __init__(self, enabled=False, dtype=None):
+        """
+
+        @param enabled: whether to autocast the forward passes
+        @param dtype: (optional) reduced precision type, picked for the device if not given
+        """
+        if dtype is None:
+            bf16 = device.type == 'cpu' or torch.cuda.is_bf16_supported()
+            dtype = torch.bfloat16 if bf16 else torch.float16
+        self.enabled = enabled
+        self.dtype = dtype
+        self.scaler = torch.amp.GradScaler(device.type, enabled=enabled and dtype == torch.float16)
+
+    def autocast(self):
+        """
+        @return: context manager running the enclosed forward passes in reduced precision
+        """
+        return torch.autocast(device.type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss):
+        """
+        backward pass of the (scaled) loss
+        @param loss: the loss
+        """
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        """
+        optimizer step with the unscaled gradients, skipped if they overflowed
+        @param optimizer: the optimizer
+        """
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+
+METRICS_FLUSH_INTERVAL = 20  # values of a metric averaged on the device before the average is logged
+
+
+class MetricsHub:
+    """
+    Logs the training metrics of a run to tensorboard without syncing the device at every step. add_scalar() only
+    adds the value to a running sum kept on the device. Every flush_interval values of a metric, the sum is handed
+    to a background thread that copies it to the host and writes the average, at the step of the last value, with
+    the single SummaryWriter of the run.
+    """
+
+    def __init__(self, log_dir, flush_interval=METRICS_FLUSH_INTERVAL):
+        """
+
+        @param log_dir: tensorboard log dir of the run
+        @param flush_interval: number of values of a metric averaged into one logged value
+        """
+        self.writer = SummaryWriter(log_dir=log_dir)
+        self.flush_interval = flush_interval
+        self.windows = {}
+        self.pending = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def add_scalar(self, tag, value, step):
+        """
+        accumulate a value of a metric
+        @param tag: name of the metric
+        @param value: a number, or a tensor whose mean is the value
+        @param step: training step of the value
+        """
+        if torch.is_tensor(value):
+            value = value.detach().float().mean()
+        total, count, _ = self.windows.get(tag, (0.0, 0, step))
+        total, count = total + value, count + 1
+        if count < self.flush_interval:
+            self.windows[tag] = (total, count, step)
+        else:
+            self.windows.pop(tag, None)
+            self.pending.put((tag, total, count, step))
+
+    def write_loop(self):
+        while True:
+            tag, total, count, step = self.pending.get()
+            try:
+                if tag is None:
+                    self.writer.flush()
+                else:
+                    self.writer.add_scalar(tag, float(total) / count, step)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.pending.task_done()
+
+    def flush(self):
+        """
+        log the average of the values accumulated since the last logged one, wait for all of them to be written
+        """
+        windows, self.windows = self.windows, {}
+        for tag, (total, count, step) in windows.items():
+            self.pending.put((tag, total, count, step))
+        self.pending.put((None, None, None, None))
+        self.pending.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+class NullMetricsHub:
+    """
+    Stands in for the MetricsHub of the data-parallel processes that don't write logs
+    """
+
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+
+metrics_hubs = {}  # MetricsHub of every log dir, keyed by process too as forked processes don't get the threads
+
+
+def get_metrics_hub(plot_dir):
+    """
+    @param plot_dir: path to store tensorboard graphs
+    @return: the MetricsHub of the run in the main process, a NullMetricsHub in the other data-parallel processes
+    """
+    if not is_main_process():
+        return NullMetricsHub()
+    key = (os.getpid(), os.path.join(plot_dir, 'runs'))
+    if key not in metrics_hubs:
+        metrics_hubs[key] = MetricsHub(key[1])
+    return metrics_hubs[key]
+
+
+PROFILE_FILE = 'profile.txt'  # per-epoch time breakdown of the profiled training loops, next to the tensorboard logs
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of the training loops. Times named spans (data loading, forward passes, sampling,
+    rewards, backward, optimizer step, checkpointing) and, at the end of every epoch, writes the time spent in
+    each of them to PROFILE_FILE. Can also record a torch.profiler trace of a window of minibatches, readable by
+    tensorboard. Spans sync the GPU when they end, so that the time of its kernels goes to the span that queued
+    them. Disabled, span() and iterate() fall through at no cost.
+    """
+
+    def __init__(self, enabled=False, trace_steps=None, log_dir='.'):
+        """
+
+        @param enabled: whether to time the spans
+        @param trace_steps: (optional) (start, stop) minibatches of the torch.profiler trace, counted from 0 over
+                            the whole training
+        @param log_dir: dir of PROFILE_FILE and of the trace
+        """
+        self.enabled = enabled
+        self.trace_steps = trace_steps
+        self.log_dir = log_dir
+        self.steps = 0
+        self.trace = None
+        self.epoch_start = None
+        self.epoch_steps = 0
+        self.totals = {}
+        self.counts = {}
+
+    def span(self, name):
+        """
+        @param name: name of the span
+        @return: context manager timing the enclosed code as the span
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed(name)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        with torch.profiler.record_function(name):
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+                self.counts[name] = self.counts.get(name, 0) + 1
+
+    def iterate(self, iterable, name='data loading'):
+        """
+        @param iterable: iterable of minibatches
+        @param name: name of the span
+        @return: the iterable, with the time taken to get each item timed as the span
+        """
+        if not self.enabled:
+            return iterable
+        return self.timed_iterate(iterable, name)
+
+    def timed_iterate(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def start_epoch(self):
+        """
+        start timing an epoch
+        """
+        if not self.enabled:
+            return
+        self.totals, self.counts = {}, {}
+        self.epoch_start = time.perf_counter()
+        self.epoch_steps = self.steps
+        self.update_trace()
+
+    def step(self):
+        """
+        end of a minibatch, starts or stops the trace when its window is reached
+        """
+        if not self.enabled:
+            return
+        self.steps += 1
+        self.update_trace()
+
+    def update_trace(self):
+        if self.trace_steps is None or not is_main_process():
+            return
+        start, stop = self.trace_steps
+        if self.trace is None and start <= self.steps < stop:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities,
+                                                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.log_dir))
+            self.trace.start()
+        elif self.trace is not None and self.steps >= stop:
+            self.stop_trace()
+
+    def stop_trace(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+            print_green(f'[Profiling] torch.profiler trace of minibatches {self.trace_steps} saved in: {self.log_dir}')
+
+    def end_epoch(self, name):
+        """
+        write the time breakdown of the epoch to PROFILE_FILE
+        @param name: name of the epoch in the breakdown
+        """
+        if not self.enabled or not is_main_process():
+            return
+        wall = time.perf_counter() - self.epoch_start
+        lines = ['%s: %.3fs over %s minibatches' % (name, wall, self.steps - self.epoch_steps)]
+        for span, total in sorted(self.totals.items(), key=lambda item: -item[1]):
+            lines.append('  %-18s %10.3fs %6.1f%% %8d calls %10.3fms/call' % (
+                span, total, 100 * total / wall, self.counts[span], 1000 * total / self.counts[span]))
+        other = wall - sum(self.totals.values())
+        lines.append('  %-18s %10.3fs %6.1f%%' % ('other', other, 100 * other / wall))
+        breakdown = '\n'.join(lines)
+        print(breakdown)
+        os.makedirs(self.log_dir, exist_ok=True)
+        with open(os.path.join(self.log_dir, PROFILE_FILE), 'a') as f:
+            f.write(breakdown + '\n')
+
+    def close(self):
+        """
+        stop the trace if its window runs past the end of the training
+        """
+        self.stop_trace()
+
+
 # Used https://github.com/Pranshu258/Deep_Image_Captioning as some of the code reference
-def train_value_network(train_data, network_paths, plot_dir, bidirectional, epochs=50, batch_size=512):
+def train_value_network(train_data, network_paths, plot_dir, bidirectional, epochs=50, batch_size=512,
+                        precision=None):
     """
     Function to train value net. Trained on Mean-Squared Error Loss.
 
@@ -132,10 +541,13 @@ def train_value_network(train_data, network_paths, plot_dir, bidirectional, epoc
     @param bidirectional: whether to use bidirectional recurrent networks
     @param epochs: num of epochs
     @param batch_size: batch size of data per epoch
+    @param precision: (optional) MixedPrecision of the forward passes
     @return: the trained value network
     """
+    if precision is None:
+        precision = MixedPrecision()
 
-    value_writer = SummaryWriter(log_dir=os.path.join(plot_dir, 'runs'))
+    metrics = get_metrics_hub(plot_dir)
 
     reward_network = RewardNetwork(train_data["word_to_idx"], pretrained_embeddings=train_data["embeddings"],
                                    bidirectional=bidirectional).to(device)
@@ -151,55 +563,63 @@ def train_value_network(train_data, network_paths, plot_dir, bidirectional, epoc
 
     value_network = ValueNetwork(train_data["word_to_idx"], pretrained_embeddings=train_data["embeddings"],
                                  bidirectional=bidirectional).to(device)
+    broadcast_parameters(value_network)
     criterion = nn.MSELoss().to(device)
     optimizer = optim.Adam(value_network.parameters(), lr=0.001)
     value_network.train(mode=True)
 
     best_loss = float('inf')
+    checkpoints = CheckpointManager(network_paths["value_network"], min_interval=CHECKPOINT_MIN_INTERVAL)
     print_green(f'[Training] Training Value Network')
+    data_generator = get_shared_generator()
 
     for epoch in range(epochs):
-        batch_progress = tqdm(get_coco_minibatches(train_data, batch_size=batch_size, split='train'),
-                              total=math.ceil(train_data['train_captions'].shape[0] / batch_size),
-                              desc='Training Value Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss))
+        batch_progress = tqdm(prefetch_coco_minibatches(train_data, batch_size=batch_size, split='train',
+                                                        generator=data_generator, rank=get_rank(),
+                                                        world_size=get_world_size()),
+                              total=count_coco_minibatches(train_data, batch_size, 'train',
+                                                           world_size=get_world_size()),
+                              desc='Training Value Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss),
+                              disable=not is_main_process())
         for minibatch_id, coco_minibatch in enumerate(batch_progress):
 
             captions, features, _ = coco_minibatch
-            features = torch.tensor(features, device=device).float()
 
-            # Generate captions using the policy network
-            captions = GenerateCaptionsGreedy(features, captions, policy_network)
+            with precision.autocast():
+                # Generate captions using the policy network
+                captions = GenerateCaptionsGreedy(features, captions, policy_network)
 
-            # Compute the reward of the generated caption using reward network
-            rewards = GetRewards(features, captions, reward_network)
+                # Compute the reward of the generated caption using reward network
+                rewards = GetRewards(features, captions, reward_network)
 
-            # Compute the value of a random state in the generation process
-            values = value_network(features, captions[:, :random.randint(1, MAX_SEQ_LEN)])
+                # Compute the value of a random state in the generation process
+                values = value_network(features, captions[:, :random.randint(1, MAX_SEQ_LEN)])
 
             # Compute the loss for the value and the reward
-            loss = criterion(values, rewards)
+            loss = criterion(values.float(), rewards.float())
 
+            minibatch_number = global_minibatch_number(epoch, minibatch_id, batch_size)
             if loss.item() < best_loss:
                 best_loss = loss.item()
-                torch.save(value_network.state_dict(), network_paths["value_network"])
+                if is_main_process():
+                    checkpoints.save(value_network.state_dict(), minibatch_number)
                 batch_progress.set_description_str(
                     'Training Value Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss))
 
-            minibatch_number = global_minibatch_number(epoch, minibatch_id, batch_size)
-            value_writer.add_scalar('Value Network-loss', loss, minibatch_number)
+            metrics.add_scalar('Value Network-loss', loss, minibatch_number)
 
             optimizer.zero_grad()
-            loss.backward(retain_graph=True)
-            optimizer.step()
-
-            # value_network.valrnn.hidden_cell = repackage_hidden(value_network.valrnn.hidden_cell)
-            value_network.valrnn.init_hidden()
-            reward_network.rewrnn.init_hidden()
+            precision.backward(loss)
+            allreduce_gradients(value_network)
+            precision.step(optimizer)
 
+    checkpoints.close()
+    metrics.flush()
     return value_network
 
 
-def train_policy_network(train_data, network_paths, plot_dir, bidirectional, epochs=100, batch_size=512):
+def train_policy_network(train_data, network_paths, plot_dir, bidirectional, epochs=100, batch_size=512,
+                         precision=None):
     """
     Function to train policy net. Trained on Cross Entropy Loss.
 
@@ -209,55 +629,66 @@ def train_policy_network(train_data, network_paths, plot_dir, bidirectional, epo
     @param bidirectional: whether to use bidirectional recurrent networks
     @param epochs: num of epochs
     @param batch_size: batch size of data per epoch
+    @param precision: (optional) MixedPrecision of the forward passes
     @return: the trained policy network
     """
+    if precision is None:
+        precision = MixedPrecision()
 
     policy_network = PolicyNetwork(train_data["word_to_idx"], pretrained_embeddings=train_data["embeddings"],
                                    bidirectional=bidirectional).to(device)
-    criterion = nn.CrossEntropyLoss().to(device)
+    broadcast_parameters(policy_network)
     optimizer = optim.Adam(policy_network.parameters(), lr=0.001)
 
-    policy_writer = SummaryWriter(log_dir=os.path.join(plot_dir, 'runs'))
+    metrics = get_metrics_hub(plot_dir)
 
     best_loss = float("inf")
+    checkpoints = CheckpointManager(network_paths["policy_network"], min_interval=CHECKPOINT_MIN_INTERVAL)
     print_green(f'[Training] Training Policy Network')
+    data_generator = get_shared_generator()
 
     for epoch in range(epochs):
 
-        batch_progress = tqdm(get_coco_minibatches(train_data, batch_size=batch_size, split='train'),
-                              total=math.ceil(train_data['train_captions'].shape[0] / batch_size),
-                              desc='Training Policy Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss))
+        batch_progress = tqdm(prefetch_coco_minibatches(train_data, batch_size=batch_size, split='train',
+                                                        with_lens=True, generator=data_generator, rank=get_rank(),
+                                                        world_size=get_world_size()),
+                              total=count_coco_minibatches(train_data, batch_size, 'train',
+                                                           world_size=get_world_size()),
+                              desc='Training Policy Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss),
+                              disable=not is_main_process())
         for minibatch_id, coco_minibatch in enumerate(batch_progress):
 
-            captions, features, _ = coco_minibatch
-            features = torch.tensor(features, device=device).float().unsqueeze(0)
-            captions_in = torch.tensor(captions[:, :-1], device=device).long()
-            captions_out = torch.tensor(captions[:, 1:], device=device).long()
-            output = policy_network(features, captions_in)
+            captions, features, _, caplens = coco_minibatch
+            features = features.unsqueeze(0)
+            captions_in = captions[:, :-1]
+            captions_out = captions[:, 1:]
+            with precision.autocast():
+                output = policy_network(features, captions_in)
 
-            loss = 0
-            for i in range(captions.shape[0]):
-                # '2' is the end of segment, hence points to caption length
-                caplen = np.nonzero(captions[i] == 2)[0][0] + 1
-                loss += (caplen / captions.shape[0]) * criterion(output[i][:caplen], captions_out[i][:caplen])
+            loss = MaskedCaptionLoss(output.float(), captions_out, caplens)
 
+            minibatch_number = global_minibatch_number(epoch, minibatch_id, batch_size)
             if loss.item() < best_loss:
                 best_loss = loss.item()
-                torch.save(policy_network.state_dict(), network_paths["policy_network"])
+                if is_main_process():
+                    checkpoints.save(policy_network.state_dict(), minibatch_number)
                 batch_progress.set_description_str(
                     'Training Policy Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss))
 
-            minibatch_number = global_minibatch_number(epoch, minibatch_id, batch_size)
-            policy_writer.add_scalar('Policy Network-loss', loss, minibatch_number)
+            metrics.add_scalar('Policy Network-loss', loss, minibatch_number)
 
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            precision.backward(loss)
+            allreduce_gradients(policy_network)
+            precision.step(optimizer)
 
+    checkpoints.close()
+    metrics.flush()
     return policy_network
 
 
-def train_reward_network(train_data, network_paths, plot_dir, bidirectional, epochs=50, batch_size=512):
+def train_reward_network(train_data, network_paths, plot_dir, bidirectional, epochs=50, batch_size=512,
+                         precision=None):
     """
     Function to train reward net. Trained on Visual Semantic Embedding Loss.
 
@@ -267,50 +698,62 @@ def train_reward_network(train_data, network_paths, plot_dir, bidirectional, epo
     @param bidirectional: whether to use bidirectional recurrent networks
     @param epochs: num of epochs
     @param batch_size: batch size of data per epoch
+    @param precision: (optional) MixedPrecision of the forward passes
     @return: the trained reward network
     """
-    reward_writer = SummaryWriter(log_dir=os.path.join(plot_dir, 'runs'))
+    if precision is None:
+        precision = MixedPrecision()
+
+    metrics = get_metrics_hub(plot_dir)
     reward_network = RewardNetwork(train_data["word_to_idx"], pretrained_embeddings=train_data["embeddings"],
                                    bidirectional=bidirectional).to(device)
+    broadcast_parameters(reward_network)
     optimizer = optim.Adam(reward_network.parameters(), lr=0.0001)
 
     best_loss = float('inf')
+    checkpoints = CheckpointManager(network_paths["reward_network"], min_interval=CHECKPOINT_MIN_INTERVAL)
     print_green(f'[Training] Training Reward Network')
+    data_generator = get_shared_generator()
 
     for epoch in range(epochs):
 
-        batch_progress = tqdm(get_coco_minibatches(train_data, batch_size=batch_size, split='train'),
-                              total=math.ceil(train_data['train_captions'].shape[0] / batch_size),
-                              desc='Training Reward Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss))
+        batch_progress = tqdm(prefetch_coco_minibatches(train_data, batch_size=batch_size, split='train',
+                                                        generator=data_generator, rank=get_rank(),
+                                                        world_size=get_world_size()),
+                              total=count_coco_minibatches(train_data, batch_size, 'train',
+                                                           world_size=get_world_size()),
+                              desc='Training Reward Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss),
+                              disable=not is_main_process())
         for minibatch_id, coco_minibatch in enumerate(batch_progress):
 
             captions, features, _ = coco_minibatch
-            features = torch.tensor(features, device=device).float()
-            captions = torch.tensor(captions, device=device).long()
-            ve, se = reward_network(features, captions)
-            loss = VisualSemanticEmbeddingLoss(ve, se)
+            with precision.autocast():
+                ve, se = reward_network(features, captions)
+            loss = VisualSemanticEmbeddingLoss(ve.float(), se.float())
 
+            minibatch_number = global_minibatch_number(epoch, minibatch_id, batch_size)
             if loss.item() < best_loss:
                 best_loss = loss.item()
-                torch.save(reward_network.state_dict(), network_paths["reward_network"])
+                if is_main_process():
+                    checkpoints.save(reward_network.state_dict(), minibatch_number)
                 batch_progress.set_description_str(
                     'Training Reward Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss))
 
-            minibatch_number = global_minibatch_number(epoch, minibatch_id, batch_size)
-            reward_writer.add_scalar('Reward Network-loss', loss, minibatch_number)
+            metrics.add_scalar('Reward Network-loss', loss, minibatch_number)
 
             optimizer.zero_grad()
-            loss.backward(retain_graph=True)
-            optimizer.step()
-
-            # reward_network.rewrnn.hidden_cell = repackage_hidden(reward_network.rewrnn.hidden_cell)
-            reward_network.rewrnn.init_hidden()
+            precision.backward(loss)
+            allreduce_gradients(reward_network)
+            precision.step(optimizer)
 
+    checkpoints.close()
+    metrics.flush()
     return reward_network
 
 
 def train_a2c_network(train_data, save_paths, network_paths, plot_dir, bidirectional, epochs, batch_size,
-                      retrain_all=False, curriculum=None):
+                      retrain_all=False, curriculum=None, sampler=None, bucketed=False, actors=0, max_staleness=4,
+                      precision=None, resume_from=None, profiler=None):
     """
     Wrapper function to call actual training functions based on input configurations
 
@@ -323,16 +766,39 @@ def train_a2c_network(train_data, save_paths, network_paths, plot_dir, bidirecti
     @param batch_size:  batch size for each epoch
     @param retrain_all: whether to retrain all nets or laod pretrained nets
     @param curriculum: curriculum levels
+    @param sampler: (optional) ActionSampler used for the rollouts
+    @param bucketed: whether to batch captions of the same length together (shorter A2C rollouts)
+    @param actors: number of rollout processes of the actor/learner training, 0 to roll out in the training loop
+    @param max_staleness: max number of updates an actor's trajectory may lag behind the learner's weights
+    @param precision: (optional) MixedPrecision of the forward passes of all the networks
+    @param resume_from: (optional) path of a training state saved by an interrupted A2C training, to resume it
+    @param profiler: (optional) Profiler timing the phases of the A2C training loop
     @return: the trained actor-critic network
     """
+    if actors > 0 and (curriculum is not None or get_world_size() > 1):
+        raise ValueError("actor/learner training can't be combined with curriculum or data-parallel training")
+    if actors > 0 and resume_from is not None:
+        raise ValueError("actor/learner training can't be resumed")
+
     model_save_path = save_paths["model_path"]
     results_save_path = save_paths["results_path"]
+    resume_path = save_paths.get("resume_path")
+
+    resume_state = None
+    if resume_from is not None:
+        print_green(f'[Training] Resuming the A2C training from: {resume_from}')
+        # the RNG states must stay on the cpu, load_state_dict moves the model and optimizer tensors to the device
+        resume_state = torch.load(resume_from, map_location='cpu', weights_only=False)
+        retrain_all = False  # the pretrained networks were already trained by the interrupted run
 
     if retrain_all:
         print_green(f'[Training] Training all the networks')
-        reward_network = train_reward_network(train_data, network_paths, plot_dir, bidirectional, batch_size=batch_size)
-        policy_network = train_policy_network(train_data, network_paths, plot_dir, bidirectional, batch_size=batch_size)
-        value_network = train_value_network(train_data, network_paths, plot_dir, bidirectional, batch_size=batch_size)
+        reward_network = train_reward_network(train_data, network_paths, plot_dir, bidirectional, batch_size=batch_size,
+                                              precision=precision)
+        policy_network = train_policy_network(train_data, network_paths, plot_dir, bidirectional, batch_size=batch_size,
+                                              precision=precision)
+        value_network = train_value_network(train_data, network_paths, plot_dir, bidirectional, batch_size=batch_size,
+                                            precision=precision)
         print_green(f'[Training] All networks trained')
 
     else:
@@ -346,7 +812,7 @@ def train_a2c_network(train_data, save_paths, network_paths, plot_dir, bidirecti
             print(f'[Training] reward network not found')
             del reward_network
             reward_network = train_reward_network(train_data, network_paths, plot_dir, bidirectional,
-                                                  batch_size=batch_size)
+                                                  batch_size=batch_size, precision=precision)
         try:
             policy_network = PolicyNetwork(train_data["word_to_idx"], pretrained_embeddings=train_data["embeddings"],
                                            bidirectional=bidirectional).to(device)
@@ -357,7 +823,7 @@ def train_a2c_network(train_data, save_paths, network_paths, plot_dir, bidirecti
             del policy_network
             print(f'[Training] policy network not found')
             policy_network = train_policy_network(train_data, network_paths, plot_dir, bidirectional,
-                                                  batch_size=batch_size)
+                                                  batch_size=batch_size, precision=precision)
         try:
             value_network = ValueNetwork(train_data["word_to_idx"], pretrained_embeddings=train_data["embeddings"],
                                          bidirectional=bidirectional).to(device)
@@ -367,39 +833,116 @@ def train_a2c_network(train_data, save_paths, network_paths, plot_dir, bidirecti
             del value_network
             print(f'[Training] value network not found')
             value_network = train_value_network(train_data, network_paths, plot_dir, bidirectional,
-                                                batch_size=batch_size)
+                                                batch_size=batch_size, precision=precision)
 
     reward_network.requires_grad_(False)
     reward_network.train(False)
 
     a2c_network = AdvantageActorCriticNetwork(value_network, policy_network).to(device)
+    if resume_state is not None:
+        a2c_network.load_state_dict(resume_state["model"])
+    broadcast_parameters(a2c_network)
     a2c_network.train(True)
 
     optimizer = optim.Adam(a2c_network.parameters(), lr=0.0001)
+    if resume_state is not None:
+        optimizer.load_state_dict(resume_state["optimizer"])
 
     print(f'[Training] train_data len = {len(train_data["train_captions"])}')
     print(f'[Training] episodes = {batch_size}')
     print(f'[Training] epochs = {epochs}')
 
+    # the run's own path first, the per-epoch copies are kept next to it and not in the shared models dir
     save_paths = [model_save_path, network_paths["a2c_network"]]
-    if curriculum is None:
+    if actors > 0:
+        a2c_network = a2c_actor_learner_training(train_data, a2c_network, reward_network, optimizer, plot_dir,
+                                                 save_paths, batch_size, epochs, actors=actors,
+                                                 max_staleness=max_staleness, sampler=sampler, bucketed=bucketed,
+                                                 precision=precision, profiler=profiler)
+    elif curriculum is None:
         a2c_network = a2c_training(train_data, a2c_network, reward_network, optimizer, plot_dir, save_paths, batch_size,
-                                   epochs)
+                                   epochs, sampler=sampler, bucketed=bucketed, precision=precision,
+                                   resume_state=resume_state, resume_path=resume_path, profiler=profiler)
     else:
         if 16 not in curriculum:
             curriculum.append(16)  # Final Curriculum Level, ie Full Training
         a2c_network = a2c_curriculum_training(train_data, a2c_network, reward_network, optimizer, plot_dir, save_paths,
-                                              batch_size, epochs, curriculum)
+                                              batch_size, epochs, curriculum, sampler=sampler, bucketed=bucketed,
+                                              precision=precision, resume_state=resume_state,
+                                              resume_path=resume_path, profiler=profiler)
 
-    with open(results_save_path, 'a') as f:
-        f.write('\n' + '-' * 10 + ' network ' + '-' * 10 + '\n')
-        f.write(str(a2c_network))
-        f.write('\n' + '-' * 10 + ' network ' + '-' * 10 + '\n')
+    if is_main_process():
+        with open(results_save_path, 'a') as f:
+            f.write('\n' + '-' * 10 + ' network ' + '-' * 10 + '\n')
+            f.write(str(a2c_network))
+            f.write('\n' + '-' * 10 + ' network ' + '-' * 10 + '\n')
 
     return a2c_network
 
 
-def a2c_training(train_data, a2c_network, reward_network, optimizer, plot_dir, save_paths, batch_size, epochs):
+RESUME_INTERVAL = 100  # minibatches between two training state checkpoints of the A2C training
+TRAINING_STATE_VERSION = 1  # bump when the layout of the training state changes
+
+
+def get_a2c_training_state(a2c_network, optimizer, sampler, precision, data_state, epoch, minibatch, best_loss,
+                           level=0):
+    """
+    Everything needed to resume the A2C training where it stopped
+    @param a2c_network: the a2c network
+    @param optimizer: the optimizer of the network
+    @param sampler: the ActionSampler of the rollouts
+    @param precision: the MixedPrecision of the forward passes
+    @param data_state: state of the data shuffling generator at the start of the epoch
+    @param epoch: the current epoch
+    @param minibatch: number of minibatches of the epoch already trained on
+    @param best_loss: best loss of the epoch(s) so far
+    @param level: index of the current curriculum level
+    @return: dict of the training state
+    """
+    return {
+        "version": TRAINING_STATE_VERSION,
+        "model": a2c_network.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scaler": precision.scaler.state_dict(),
+        "sampler": sampler.generator.get_state() if sampler.generator is not None else None,
+        "rng": get_rng_state(),
+        "data": data_state,
+        "world_size": get_world_size(),
+        "level": level,
+        "epoch": epoch,
+        "minibatch": minibatch,
+        "best_loss": best_loss,
+    }
+
+
+def restore_a2c_training_state(state, data_generator, sampler, precision):
+    """
+    Restore the random generators and loss scaler of a training state, the network and optimizer are restored by
+    train_a2c_network
+    @param state: dict returned by get_a2c_training_state
+    @param data_generator: the generator shuffling the data, set back to the start of the interrupted epoch
+    @param sampler: the ActionSampler of the rollouts
+    @param precision: the MixedPrecision of the forward passes
+    """
+    if state["version"] != TRAINING_STATE_VERSION:
+        raise ValueError("Unsupported training state version", state["version"])
+    if state["world_size"] != get_world_size():
+        raise ValueError("Training state saved by a different number of data-parallel processes",
+                         state["world_size"], get_world_size())
+
+    set_rng_state(state["rng"])
+    if get_rank() > 0:
+        # the state holds the main process's generators, the other processes need rollouts of their own
+        torch.manual_seed(torch.initial_seed() + get_rank())
+    data_generator.set_state(state["data"])
+    if sampler.generator is not None and state["sampler"] is not None:
+        sampler.generator.set_state(state["sampler"])
+    precision.scaler.load_state_dict(state["scaler"])
+
+
+def a2c_training(train_data, a2c_network, reward_network, optimizer, plot_dir, save_paths, batch_size, epochs,
+                 sampler=None, bucketed=False, precision=None, resume_state=None, resume_path=None,
+                 resume_interval=RESUME_INTERVAL, profiler=None):
     """
     Train the a2c model. Trained on Advantage-Weighted Log Probability Loss.
 
@@ -408,100 +951,143 @@ def a2c_training(train_data, a2c_network, reward_network, optimizer, plot_dir, s
     @param reward_network: the reward net for predicting rewards
     @param optimizer: the optimizer of the network
     @param plot_dir: path to store tensorboard graphs
-    @param save_paths: path to save trained nets
+    @param save_paths: paths to save trained nets, the first one in the run's dir (per-epoch copies are kept there)
     @param batch_size: batch size for each epoch
     @param epochs: the number of epochs for data passes
+    @param sampler: (optional) ActionSampler used for the rollouts
+    @param bucketed: whether to batch captions of the same length together (shorter rollouts)
+    @param precision: (optional) MixedPrecision of the forward passes
+    @param resume_state: (optional) training state (see get_a2c_training_state) to resume from
+    @param resume_path: (optional) path to save the training state at, to be able to resume the training
+    @param resume_interval: number of minibatches between two saves of the training state
+    @param profiler: (optional) Profiler timing the phases of the training loop
     @return: the trained actor-critic network
     """
-    a2c_train_writer = SummaryWriter(log_dir=os.path.join(plot_dir, 'runs'))
+    metrics = get_metrics_hub(plot_dir)
+    if sampler is None:
+        sampler = ActionSampler()
+    if precision is None:
+        precision = MixedPrecision()
+    if profiler is None:
+        profiler = Profiler()
 
     print_green(f'[Training] Training Advantage Actor-Critic Network')
-    best_loss = float('inf')
-
-    for epoch in range(epochs):
+    best_loss = torch.tensor(float('inf'), device=device)  # kept on the device, read every METRICS_FLUSH_INTERVAL
+    data_generator = get_shared_generator()
+    checkpoints = CheckpointManager(save_paths, keep_last=CHECKPOINT_KEEP_LAST)
+    if resume_path is not None:
+        state_checkpoints = CheckpointManager(resume_path)
+
+    epoch_minibatches = count_coco_minibatches(train_data, batch_size, 'train', bucketed, world_size=get_world_size())
+    start_epoch, start_minibatch = 0, 0
+    if resume_state is not None:
+        restore_a2c_training_state(resume_state, data_generator, sampler, precision)
+        start_epoch, start_minibatch = resume_state["epoch"], resume_state["minibatch"]
+        best_loss.fill_(resume_state["best_loss"])
+        print_green(f'[Training] Resuming at epoch {start_epoch + 1}, minibatch {start_minibatch}')
+
+    for epoch in range(start_epoch, epochs):
+
+        data_state = data_generator.get_state()
+        start = start_minibatch if epoch == start_epoch else 0
+        profiler.start_epoch()
+        minibatches = prefetch_coco_minibatches(train_data, batch_size=batch_size, split='train', with_lens=True,
+                                                bucketed=bucketed, generator=data_generator, rank=get_rank(),
+                                                world_size=get_world_size(), start=start)
+        batch_progress = tqdm(profiler.iterate(minibatches), total=epoch_minibatches, initial=start,
+                              desc='Training A2C Network (%s/%s): Best Loss %s' % (epoch + 1, epochs,
+                                                                                  best_loss.item()),
+                              disable=not is_main_process())
+        for minibatch_id, coco_minibatch in enumerate(batch_progress, start):
+
+            captions, features, _, caplens = coco_minibatch
 
-        batch_progress = tqdm(get_coco_minibatches(train_data, batch_size=batch_size, split='train'),
-                              total=math.ceil(train_data['train_captions'].shape[0] / batch_size),
-                              desc='Training A2C Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss))
-        for minibatch_id, coco_minibatch in enumerate(batch_progress):
-
-            captions, features, _ = coco_minibatch
-            features = torch.tensor(features, device=device).float()
-            captions = torch.tensor(captions, device=device).long()
-
-            rewards = []
             values = []
             log_probs = []
 
-            caplen = np.nonzero(captions == 2)[:, 1].max() + 1
-
-            captions_in = captions[:, :1]
-            features_in = features
+            caplen = int(caplens.max())
 
-            for step in range(caplen - 1):
+            with precision.autocast():
+                captions_in = captions[:, :1]
+                features_in = features
 
-                value, probs = a2c_network(features_in, captions_in)
-                probs = F.softmax(probs, dim=2)
-                dist = probs.cpu().detach().numpy()[:, 0]
+                for step in range(caplen - 1):
 
-                actions = []
-                for i in range(dist.shape[0]):
-                    actions.append(np.random.choice(probs.shape[-1], p=dist[i]))
-                actions = torch.from_numpy(np.array(actions))
+                    with profiler.span('policy forward'):
+                        value, probs = a2c_network(features_in, captions_in)
+                    with profiler.span('sampling'):
+                        actions = sampler(probs[:, 0])
+                        captions_in = torch.cat((captions_in, actions.unsqueeze(-1)), axis=1)
 
-                gen_cap = actions.unsqueeze(-1).to(device)
-                try:
-                    captions_in = torch.cat((captions_in, gen_cap), axis=1)
-                except:
-                    captions_in = torch.cat((captions_in, gen_cap.long()), axis=1)
+                        log_prob = sampler.log_prob(probs[:, 0], actions)
 
-                log_prob = torch.log(probs[:, 0, :].gather(1, actions.view(-1, 1).to(device)))
-                reward = GetRewards(features_in, captions_in, reward_network)
+                    values.append(value)
+                    log_probs.append(log_prob)
 
-                rewards.append(reward)
-                values.append(value)
-                log_probs.append(log_prob)
+                    del probs, actions
 
-                del gen_cap, probs, actions, dist
+                # reward of every generated prefix, from a single pass over the finished rollout
+                with profiler.span('rewards'):
+                    rewards = GetPrefixRewards(features_in, captions_in, reward_network, start=1)
 
-            values = torch.stack(values, axis=1).squeeze().to(device)
-            rewards = torch.stack(rewards, axis=1).squeeze().to(device)
-            log_probs = torch.stack(log_probs, axis=1).squeeze().to(device)
+            rewards = rewards.float()
+            values = torch.stack(values, axis=1).squeeze(-1).to(device).float()
+            log_probs = torch.stack(log_probs, axis=1).squeeze(-1).to(device).float()
 
             advantage = values - rewards
             actorLoss = (-log_probs * advantage).mean()
             criticLoss = 0.5 * advantage.pow(2).mean()
 
             loss = actorLoss + criticLoss
-            episodic_avg_loss = loss.mean().item()
+            episodic_avg_loss = loss.detach().mean()
 
-            optimizer.zero_grad()
-            loss.mean().backward(retain_graph=True)
-            optimizer.step()
+            with profiler.span('backward'):
+                optimizer.zero_grad()
+                precision.backward(loss.mean())
+            with profiler.span('optimizer step'):
+                allreduce_gradients(a2c_network)
+                precision.step(optimizer)
 
-            if episodic_avg_loss < best_loss:
-                best_loss = episodic_avg_loss
+            best_loss = torch.minimum(best_loss, episodic_avg_loss)
+            if is_main_process() and (minibatch_id + 1) % METRICS_FLUSH_INTERVAL == 0:
                 batch_progress.set_description_str(
-                    'Training A2C Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss))
+                    'Training A2C Network (%s/%s): Best Loss %s' % (epoch + 1, epochs, best_loss.item()))
 
             # Summary Writer
             minibatch_number = global_minibatch_number(epoch, minibatch_id, batch_size)
-            a2c_train_writer.add_scalar('A2C Network-episodic-loss', episodic_avg_loss, minibatch_number)
-            a2c_train_writer.add_scalar('A2C Network-episodic-mean-rewards', rewards.mean(), minibatch_number)
-            a2c_train_writer.add_scalar('A2C Network-episodic-mean-advantage', advantage.mean().item(),
-                                        minibatch_number)
-
-            # a2c_network.value_network.valrnn.hidden_cell = repackage_hidden(a2c_network.value_network.valrnn.hidden_cell)
-            reward_network.rewrnn.init_hidden()
-            a2c_network.value_network.valrnn.init_hidden()
-
-        save_a2c_model(a2c_network, save_paths)
-
+            metrics.add_scalar('A2C Network-episodic-loss', episodic_avg_loss, minibatch_number)
+            metrics.add_scalar('A2C Network-episodic-mean-rewards', rewards.mean(), minibatch_number)
+            metrics.add_scalar('A2C Network-episodic-mean-advantage', advantage.mean(), minibatch_number)
+
+            if resume_path is not None and is_main_process() and (minibatch_id + 1) % resume_interval == 0:
+                with profiler.span('checkpointing'):
+                    state_checkpoints.save(get_a2c_training_state(a2c_network, optimizer, sampler, precision,
+                                                                  data_state, epoch, minibatch_id + 1,
+                                                                  best_loss.item()),
+                                           epoch * epoch_minibatches + minibatch_id + 1)
+            profiler.step()
+
+        if is_main_process():
+            with profiler.span('checkpointing'):
+                checkpoints.save(a2c_network.state_dict(), epoch + 1)
+                if resume_path is not None:
+                    state_checkpoints.save(get_a2c_training_state(a2c_network, optimizer, sampler, precision,
+                                                                  data_generator.get_state(), epoch + 1, 0,
+                                                                  best_loss.item()),
+                                           (epoch + 1) * epoch_minibatches)
+        profiler.end_epoch('A2C Network epoch %s' % (epoch + 1))
+
+    checkpoints.close()
+    if resume_path is not None:
+        state_checkpoints.close()
+    profiler.close()
+    metrics.flush()
     return a2c_network
 
 
 def a2c_curriculum_training(train_data, a2c_network, reward_network, optimizer, plot_dir, save_paths, batch_size,
-                            epochs, curriculum):
+                            epochs, curriculum, sampler=None, bucketed=False, precision=None, resume_state=None,
+                            resume_path=None, resume_interval=RESUME_INTERVAL, profiler=None):
     """
     Train the model based on Curriculum Learning. 
     Start out training on the last few words of each caption, and increase the
@@ -514,152 +1100,582 @@ def a2c_curriculum_training(train_data, a2c_network, reward_network, optimizer,
     @param reward_network: the reward net for predicting rewards
     @param optimizer: the optimizer of the network
     @param plot_dir: path to store tensorboard graphs
-    @param save_paths: path to save trained nets
+    @param save_paths: paths to save trained nets, the first one in the run's dir (per-epoch copies are kept there)
     @param batch_size: batch size for each epoch
     @param epochs: the number of epochs for data passes
     @param curriculum: curriculum levels
+    @param sampler: (optional) ActionSampler used for the rollouts
+    @param bucketed: whether to batch captions of the same length together (shorter rollouts)
+    @param precision: (optional) MixedPrecision of the forward passes
+    @param resume_state: (optional) training state (see get_a2c_training_state) to resume from
+    @param resume_path: (optional) path to save the training state at, to be able to resume the training
+    @param resume_interval: number of minibatches between two saves of the training state
+    @param profiler: (optional) Profiler timing the phases of the training loop
     @return: the trained actor-critic network
     """
-    a2c_train_curriculum_writer = SummaryWriter(log_dir=os.path.join(plot_dir, 'runs'))
+    metrics = get_metrics_hub(plot_dir)
+    if sampler is None:
+        sampler = ActionSampler()
+    if precision is None:
+        precision = MixedPrecision()
+    if profiler is None:
+        profiler = Profiler()
 
     print_green(f'[Training] Training Advantage Actor-Critic Network')
     print_green(f'[Training] mode set to curriculum training using levels: {curriculum}')
-
-    for level in curriculum:
+    data_generator = get_shared_generator()
+    checkpoints = CheckpointManager(save_paths, keep_last=CHECKPOINT_KEEP_LAST)
+    if resume_path is not None:
+        state_checkpoints = CheckpointManager(resume_path)
+
+    epoch_minibatches = count_coco_minibatches(train_data, batch_size, 'train', bucketed, world_size=get_world_size())
+    start_level, start_epoch, start_minibatch = 0, 0, 0
+    if resume_state is not None:
+        restore_a2c_training_state(resume_state, data_generator, sampler, precision)
+        start_level, start_epoch = resume_state["level"], resume_state["epoch"]
+        start_minibatch = resume_state["minibatch"]
+        if start_level < len(curriculum):
+            print_green(f'[Training] Resuming at curriculum level {curriculum[start_level]}, '
+                        f'epoch {start_epoch + 1}, minibatch {start_minibatch}')
+
+    for level_index in range(start_level, len(curriculum)):
+        level = curriculum[level_index]
         print_green(f'[Training] Training curriculum level: {level}')
-        best_loss = float('inf')
-
-        for epoch in range(epochs):
-
-            batch_progress = tqdm(get_coco_minibatches(train_data, batch_size=batch_size, split='train'),
-                                  total=math.ceil(train_data['train_captions'].shape[0] / batch_size),
+        resuming = resume_state is not None and level_index == start_level
+        # kept on the device, read every METRICS_FLUSH_INTERVAL minibatches
+        best_loss = torch.tensor(resume_state["best_loss"] if resuming else float('inf'), device=device)
+
+        for epoch in range(start_epoch if resuming else 0, epochs):
+
+            data_state = data_generator.get_state()
+            start = start_minibatch if resuming and epoch == start_epoch else 0
+            profiler.start_epoch()
+            minibatches = prefetch_coco_minibatches(train_data, batch_size=batch_size, split='train', with_lens=True,
+                                                    bucketed=bucketed, generator=data_generator, rank=get_rank(),
+                                                    world_size=get_world_size(), start=start)
+            batch_progress = tqdm(profiler.iterate(minibatches), total=epoch_minibatches, initial=start,
                                   desc='Training A2C Curriculum Level %s (%s/%s): Best Loss: %s' % (
-                                  level, epoch, epochs, best_loss))
-            for minibatch_id, coco_minibatch in enumerate(batch_progress):
+                                  level, epoch, epochs, best_loss.item()),
+                                  disable=not is_main_process())
+            for minibatch_id, coco_minibatch in enumerate(batch_progress, start):
 
-                captions, features, _ = coco_minibatch
-                features = torch.tensor(features, device=device).float()
-                captions = torch.tensor(captions, device=device).long()
+                captions, features, _, caplens = coco_minibatch
 
                 log_probs = []
                 values = []
                 rewards = []
-                caplen = np.nonzero(captions == 2)[:, 1].max() + 1
+                caplen = int(caplens.max())
                 curr_seq_len = caplen - level
 
                 if (curr_seq_len >= 1):
-                    captions_in = captions[:, :curr_seq_len]
-                    features_in = features
+                    with precision.autocast():
+                        captions_in = captions[:, :curr_seq_len]
+                        features_in = features
 
-                    for step in range(level):
-                        value, probs = a2c_network(features_in, captions_in)
-                        probs = F.softmax(probs, dim=2)
-
-                        dist = probs.cpu().detach().numpy()[:, 0]
-                        actions = []
-                        for i in range(dist.shape[0]):
-                            actions.append(np.random.choice(probs.shape[-1], p=dist[i]))
-                        actions = torch.from_numpy(np.array(actions))
+                        for step in range(level):
+                            with profiler.span('policy forward'):
+                                value, probs = a2c_network(features_in, captions_in)
+                            with profiler.span('sampling'):
+                                actions = sampler(probs[:, 0])
 
-                        gen_cap = actions.unsqueeze(-1).to(device)
-                        captions_in = torch.cat((captions_in, gen_cap), axis=1)
-                        log_prob = torch.log(probs[:, 0, :].gather(1, actions.view(-1, 1).to(device)))
+                                captions_in = torch.cat((captions_in, actions.unsqueeze(-1)), axis=1)
+                                log_prob = sampler.log_prob(probs[:, 0], actions)
 
-                        reward = GetRewards(features_in, captions_in, reward_network)
+                            values.append(value)
+                            log_probs.append(log_prob)
 
-                        rewards.append(reward)
-                        values.append(value)
-                        log_probs.append(log_prob)
+                            del probs, actions
 
-                        del gen_cap, probs, actions, dist
+                        with profiler.span('rewards'):
+                            rewards = GetPrefixRewards(features_in, captions_in, reward_network, start=curr_seq_len)
 
-                    values = torch.stack(values, axis=1).squeeze().to(device)
-                    rewards = torch.stack(rewards, axis=1).squeeze().to(device)
-                    log_probs = torch.stack(log_probs, axis=1).squeeze().to(device)
+                    rewards = rewards.float()
+                    values = torch.stack(values, axis=1).squeeze(-1).to(device).float()
+                    log_probs = torch.stack(log_probs, axis=1).squeeze(-1).to(device).float()
 
                     advantage = values - rewards
                     actorLoss = (-log_probs * advantage).mean(axis=1)
                     criticLoss = 0.5 * advantage.pow(2).mean(axis=1)
 
                     loss = actorLoss + criticLoss
-                    episodic_avg_loss = loss.mean().item()
+                    episodic_avg_loss = loss.detach().mean()
 
-                    if episodic_avg_loss < best_loss:
-                        best_loss = episodic_avg_loss
+                    best_loss = torch.minimum(best_loss, episodic_avg_loss)
+                    if is_main_process() and (minibatch_id + 1) % METRICS_FLUSH_INTERVAL == 0:
                         batch_progress.set_description_str('Training A2C Curriculum Level %s (%s/%s): Best Loss: %s' % (
-                        level, epoch, epochs, best_loss))
+                        level, epoch, epochs, best_loss.item()))
 
-                    optimizer.zero_grad()
-                    loss.mean().backward(retain_graph=True)
-                    optimizer.step()
+                    with profiler.span('backward'):
+                        optimizer.zero_grad()
+                        precision.backward(loss.mean())
+                    with profiler.span('optimizer step'):
+                        if allreduce_gradients(a2c_network):
+                            precision.step(optimizer)
 
                     # Summary Writer
                     minibatch_number = global_minibatch_number(epoch, minibatch_id, batch_size)
                     writer_var_name = 'A2C Curriculum' + ' Level-' + str(level) + '-loss'
-                    a2c_train_curriculum_writer.add_scalar(writer_var_name, episodic_avg_loss, minibatch_number)
+                    metrics.add_scalar(writer_var_name, episodic_avg_loss, minibatch_number)
                     writer_var_name = 'A2C Curriculum' + ' Level-' + str(level) + '-mean-rewards'
-                    a2c_train_curriculum_writer.add_scalar(writer_var_name, rewards.mean(), minibatch_number)
+                    metrics.add_scalar(writer_var_name, rewards.mean(), minibatch_number)
                     writer_var_name = 'A2C Curriculum' + ' Level-' + str(level) + '-mean-advantage'
-                    a2c_train_curriculum_writer.add_scalar(writer_var_name, advantage.mean().item(), minibatch_number)
+                    metrics.add_scalar(writer_var_name, advantage.mean(), minibatch_number)
 
                     log_probs.detach()
                     values.detach()
                     rewards.detach()
+                elif get_world_size() > 1:
+                    # the other processes may have trained on this step, take part in averaging their gradients
+                    optimizer.zero_grad()
+                    with profiler.span('optimizer step'):
+                        if allreduce_gradients(a2c_network, contributes=False):
+                            precision.step(optimizer)
                 del log_probs, values, rewards
 
-                # a2c_network.value_network.valrnn.hidden_cell = repackage_hidden(a2c_network.value_network.valrnn.hidden_cell)
-                reward_network.rewrnn.init_hidden()
-                a2c_network.value_network.valrnn.init_hidden()
+                if resume_path is not None and is_main_process() and (minibatch_id + 1) % resume_interval == 0:
+                    with profiler.span('checkpointing'):
+                        state_checkpoints.save(get_a2c_training_state(a2c_network, optimizer, sampler, precision,
+                                                                      data_state, epoch, minibatch_id + 1,
+                                                                      best_loss.item(), level_index),
+                                               (level_index * epochs + epoch) * epoch_minibatches + minibatch_id + 1)
+                profiler.step()
+
+            trained_epochs = level_index * epochs + epoch + 1
+            if is_main_process():
+                with profiler.span('checkpointing'):
+                    checkpoints.save(a2c_network.state_dict(), trained_epochs)
+                    if resume_path is not None:
+                        # the next epoch to train may be the first one of the next level
+                        next_level, next_epoch = divmod(trained_epochs, epochs)
+                        next_best_loss = best_loss.item() if next_level == level_index else float('inf')
+                        state_checkpoints.save(get_a2c_training_state(a2c_network, optimizer, sampler, precision,
+                                                                      data_generator.get_state(), next_epoch, 0,
+                                                                      next_best_loss, next_level),
+                                               trained_epochs * epoch_minibatches)
+            profiler.end_epoch('A2C Curriculum Level %s epoch %s' % (level, epoch + 1))
+
+    checkpoints.close()
+    if resume_path is not None:
+        state_checkpoints.close()
+    profiler.close()
+    metrics.flush()
+    return a2c_network
+
+
+def get_start_method():
+    """
+    @return: start method of the training processes. On CPU they are forked and share the dataset with this process
+    """
+    return 'fork' if device.type == 'cpu' else 'spawn'
+
+
+def a2c_actor_learner_training(train_data, a2c_network, reward_network, optimizer, plot_dir, save_paths, batch_size,
+                               epochs, actors=2, publish_interval=1, max_staleness=4, queue_size=4, sampler=None,
+                               bucketed=False, precision=None, profiler=None):
+    """
+    Train the a2c model with rollouts generated by separate actor processes. Every actor samples captions with
+    a recent copy of the a2c network's weights, scores them with the reward network and sends the trajectories
+    through a shared-memory queue. This process is the learner: it computes the Advantage-Weighted Log
+    Probability Loss of the trajectories with its current weights, applies the updates and publishes its
+    weights to the actors every publish_interval updates.
+
+    Trajectories are off-policy by the number of updates made since the weights that sampled them were
+    published. Trajectories staler than max_staleness updates are dropped, and the staleness is reported.
 
-            save_a2c_model(a2c_network, save_paths)
+    @param train_data: the dataset for training
+    @param a2c_network: the a2c network
+    @param reward_network: the reward net for predicting rewards
+    @param optimizer: the optimizer of the network
+    @param plot_dir: path to store tensorboard graphs
+    @param save_paths: paths to save trained nets, the first one in the run's dir (per-epoch copies are kept there)
+    @param batch_size: batch size for each epoch
+    @param epochs: the number of epochs for data passes
+    @param actors: number of rollout processes
+    @param publish_interval: number of updates between two weight publications
+    @param max_staleness: max number of updates a trajectory may lag behind the learner's weights
+    @param queue_size: max number of trajectories waiting for the learner
+    @param sampler: (optional) ActionSampler used for the rollouts
+    @param bucketed: whether to batch captions of the same length together (shorter rollouts)
+    @param precision: (optional) MixedPrecision of the forward passes, of the learner and the actors
+    @param profiler: (optional) Profiler timing the phases of the learner, the rollouts of the actors aren't timed
+    @return: the trained actor-critic network
+    """
+    metrics = get_metrics_hub(plot_dir)
+    if sampler is None:
+        sampler = ActionSampler()
+    if precision is None:
+        precision = MixedPrecision()
+    if profiler is None:
+        profiler = Profiler()
+
+    print_green(f'[Training] Training Advantage Actor-Critic Network with {actors} rollout actors')
+    checkpoints = CheckpointManager(save_paths, keep_last=CHECKPOINT_KEEP_LAST)
+    context = torch.multiprocessing.get_context(get_start_method())
+
+    # the weights the actors sample with, refreshed by the learner
+    published_network = copy.deepcopy(a2c_network).share_memory()
+    published_network.train(False)
+    published_version = context.Value('i', 0)
+    publish_lock = context.Lock()
+
+    trajectories = context.Queue(maxsize=queue_size)
+    done = context.Event()
+    seed = torch.randint(2 ** 62, (1,)).item()
+    actor_processes = [context.Process(target=a2c_rollout_actor,
+                                       args=(actor_id, actors, train_data, published_network, published_version,
+                                             publish_lock, reward_network, trajectories, done, batch_size, epochs,
+                                             sampler, bucketed, precision.enabled, seed), daemon=True)
+                       for actor_id in range(actors)]
+    for process in actor_processes:
+        process.start()
+
+    total = count_coco_minibatches(train_data, batch_size, 'train', bucketed, world_size=actors) * actors
+    batch_progress = tqdm(total=total * epochs, desc='Training A2C Network: Best Loss inf')
+    best_loss = torch.tensor(float('inf'), device=device)  # kept on the device, read every METRICS_FLUSH_INTERVAL
+    updates = 0
+    dropped = 0
+    received = 0  # trajectories used or dropped, an epoch ends every total trajectories
+    staleness_sum = 0
+    staleness_max = 0
+    finished_actors = 0
+    profiler.start_epoch()
+
+    try:
+        while finished_actors < actors:
+            with profiler.span('waiting for actors'):
+                item = trajectories.get()
+            if item is None:
+                finished_actors += 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+
+            features, captions, rewards, version = item
+            batch_progress.update(1)
+            received += 1
+            staleness = updates - version
+            if staleness > max_staleness:
+                dropped += 1
+                if received % total == 0:
+                    with profiler.span('checkpointing'):
+                        checkpoints.save(a2c_network.state_dict(), updates)
+                continue
+            staleness_sum += staleness
+            staleness_max = max(staleness_max, staleness)
+
+            features = features.to(device)
+            captions = captions.to(device)
+            rewards = rewards.to(device)
 
+            values = []
+            log_probs = []
+            with precision.autocast(), profiler.span('policy forward'):
+                for step in range(captions.shape[1] - 1):
+                    value, probs = a2c_network(features, captions[:, :step + 1])
+                    log_prob = sampler.log_prob(probs[:, 0], captions[:, step + 1])
+                    values.append(value)
+                    log_probs.append(log_prob)
+
+            values = torch.stack(values, axis=1).squeeze(-1).float()
+            log_probs = torch.stack(log_probs, axis=1).squeeze(-1).float()
+
+            advantage = values - rewards
+            actorLoss = (-log_probs * advantage).mean()
+            criticLoss = 0.5 * advantage.pow(2).mean()
+
+            loss = actorLoss + criticLoss
+            episodic_avg_loss = loss.detach().mean()
+
+            with profiler.span('backward'):
+                optimizer.zero_grad()
+                precision.backward(loss.mean())
+            with profiler.span('optimizer step'):
+                precision.step(optimizer)
+            updates += 1
+
+            if updates % publish_interval == 0:
+                with publish_lock, profiler.span('publishing'):
+                    with torch.no_grad():
+                        for published, current in zip(published_network.state_dict().values(),
+                                                      a2c_network.state_dict().values()):
+                            published.copy_(current)
+                    published_version.value = updates
+
+            best_loss = torch.minimum(best_loss, episodic_avg_loss)
+            if updates % METRICS_FLUSH_INTERVAL == 0:
+                batch_progress.set_description_str('Training A2C Network: Best Loss %s' % best_loss.item())
+
+            metrics.add_scalar('A2C Network-episodic-loss', episodic_avg_loss, updates)
+            metrics.add_scalar('A2C Network-episodic-mean-rewards', rewards.mean(), updates)
+            metrics.add_scalar('A2C Network-episodic-mean-advantage', advantage.mean(), updates)
+            metrics.add_scalar('A2C Network-policy-staleness', staleness, updates)
+
+            if received % total == 0:
+                with profiler.span('checkpointing'):
+                    checkpoints.save(a2c_network.state_dict(), updates)
+            profiler.step()
+    finally:
+        done.set()
+        batch_progress.close()
+        for process in actor_processes:
+            # actors still blocked on a full queue when the learner failed won't exit on their own
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    checkpoints.save(a2c_network.state_dict(), updates)
+    checkpoints.close()
+    profiler.end_epoch('A2C Network learner')
+    profiler.close()
+    metrics.flush()
+    print_green(f'[Training] {updates} updates, {dropped} stale trajectories dropped, policy staleness: '
+                f'mean {staleness_sum / max(updates, 1):.2f} max {staleness_max} (bound {max_staleness})')
     return a2c_network
 
 
-def test_a2c_network(a2c_network, test_data, image_caption_data, data_size, validation_batch_size=128):
+def a2c_rollout_actor(actor_id, actors, train_data, published_network, published_version, publish_lock,
+                      reward_network, trajectories, done, batch_size, epochs, sampler, bucketed, mixed_precision,
+                      seed):
+    """
+    Entry point of a rollout process started by a2c_actor_learner_training. Samples a caption for every item
+    of its share of the minibatches, using the latest published weights, and sends the trajectory with its
+    rewards and the version of the weights to the learner.
+    """
+    torch.set_num_threads(max(1, os.cpu_count() // (actors + 1)))
+    torch.manual_seed(seed + actor_id + 1)
+    if sampler.generator is not None:
+        sampler.generator.manual_seed(sampler.generator.initial_seed() + actor_id)
+
+    precision = MixedPrecision(mixed_precision)
+    a2c_network = copy.deepcopy(published_network)
+    policy_network = a2c_network.policy_network
+    version = -1
+    data_generator = torch.Generator()
+    data_generator.manual_seed(seed)
+
+    try:
+        with torch.no_grad(), precision.autocast():
+            for epoch in range(epochs):
+                for coco_minibatch in prefetch_coco_minibatches(train_data, batch_size=batch_size, split='train',
+                                                                with_lens=True, bucketed=bucketed,
+                                                                generator=data_generator, rank=actor_id,
+                                                                world_size=actors):
+                    if published_version.value != version:
+                        with publish_lock:
+                            a2c_network.load_state_dict(published_network.state_dict())
+                            version = published_version.value
+
+                    captions, features, _, caplens = coco_minibatch
+                    caplen = int(caplens.max())
+
+                    captions_in = captions[:, :1]
+                    if not policy_network.bidirectional:
+                        state = policy_network.init_state(features.unsqueeze(0))
+                    for step in range(caplen - 1):
+                        if policy_network.bidirectional:
+                            logits = policy_network(features.unsqueeze(0), captions_in)[:, -1]
+                        else:
+                            logits, state = policy_network.step(captions_in[:, -1], state)
+                        actions = sampler(logits)
+                        captions_in = torch.cat((captions_in, actions.unsqueeze(-1)), axis=1)
+
+                    rewards = GetPrefixRewards(features, captions_in, reward_network, start=1).float()
+                    trajectories.put((features.cpu(), captions_in.cpu(), rewards.cpu(), version))
+        trajectories.put(None)
+    except Exception as e:
+        trajectories.put(e)
+
+    # the learner has to receive the shared tensors before this process exits
+    done.wait()
+
+
+def train_data_parallel(workers, train_fn, *args, seed=0, **kwargs):
+    """
+    Run train_fn in workers processes on this machine. The processes form a gloo process group, every process
+    trains on its share of the minibatches and the gradients are averaged over the processes at every step,
+    so each step trains on workers * batch_size items. Only the first process saves the networks and writes logs.
+    On CPU the processes are forked and share the dataset with this process.
+
+    @param workers: number of processes
+    @param train_fn: the training function, e.g. train_a2c_network
+    @param args: positional arguments of train_fn
+    @param seed: seed of the random generators, offset by the rank of each process
+    @param kwargs: keyword arguments of train_fn
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    start_method = get_start_method()
+    print_green(f'[Training] Training data-parallel in {workers} processes')
+    torch.multiprocessing.start_processes(data_parallel_worker, args=(workers, port, seed, train_fn, args, kwargs),
+                                          nprocs=workers, join=True, start_method=start_method)
+
+
+def data_parallel_worker(rank, world_size, port, seed, train_fn, args, kwargs):
+    """
+    Entry point of a process started by train_data_parallel
+    """
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    torch.manual_seed(seed + rank)
+    random.seed(seed + rank)
+    np.random.seed(seed + rank)
+
+    # every process samples its own rollouts
+    sampler = kwargs.get('sampler')
+    if sampler is not None and sampler.generator is not None:
+        sampler.generator.manual_seed(sampler.generator.initial_seed() + rank)
+
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size)
+    try:
+        with contextlib.ExitStack() as stack:
+            # only the first process reports progress
+            if rank != 0:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+            train_fn(*args, **kwargs)
+    finally:
+        dist.destroy_process_group()
+
+
+def test_a2c_network(a2c_network, test_data, image_caption_data, data_size, validation_batch_size=128,
+                     full_validation=False, shards=1, precision=None):
     """
     Function to test the a2c network
     @param a2c_network: the a2c network
     @param test_data: the dataset for testing
     @param image_caption_data: paths to store results
-    @param data_size: size of the test data
+    @param data_size: size of the test data, sampled with replacement (ignored with full_validation)
     @param validation_batch_size: batch size to sample the data
+    @param full_validation: whether to test on every item of the val split once, in dataset order
+    @param shards: number of processes the full validation is split in, None for one per core
+    @param precision: (optional) MixedPrecision of the forward passes
     """
-    with torch.no_grad():
-        a2c_network.train(False)
-
-        real_captions_filename = image_caption_data["real_captions_path"]
-        generated_captions_filename = image_caption_data["generated_captions_path"]
-        image_url_filename = image_caption_data["image_urls_path"]
-
-        real_captions_file = open(real_captions_filename, "a")
-        generated_captions_file = open(generated_captions_filename, "a")
-        image_url_file = open(image_url_filename, "a")
-
+    mixed_precision = precision is not None and precision.enabled
+    results_path = image_caption_data["caption_results_path"]
+    if not full_validation:
         captions_real_all, features_real_all, urls_all = get_coco_batch(test_data, batch_size=data_size, split='val')
-        val_captions_lens = len(captions_real_all)
+        caption_a2c_shard(a2c_network, captions_real_all, features_real_all, urls_all, test_data["idx_to_word"],
+                          results_path, validation_batch_size, mixed_precision=mixed_precision)
+        return
+
+    if shards is None:
+        shards = os.cpu_count()
+    if shards == 1:
+        captions_real_all, features_real_all, urls_all = get_coco_shard(test_data, 0, 1, split='val')
+        caption_a2c_shard(a2c_network, captions_real_all, features_real_all, urls_all, test_data["idx_to_word"],
+                          results_path, validation_batch_size, mixed_precision=mixed_precision)
+        return
+
+    print_green(f'[Testing] Testing full val split in {shards} shards')
+    threads = max(1, os.cpu_count() // shards)
+    shard_paths = ['%s.shard%d' % (results_path, shard) for shard in range(shards)]
+    shard_args = []
+    for shard in range(shards):
+        captions_real, features_real, urls = get_coco_shard(test_data, shard, shards, split='val')
+        shard_args.append((a2c_network, captions_real, features_real, urls, test_data["idx_to_word"],
+                           shard_paths[shard], validation_batch_size, threads, False, mixed_precision))
+
+    with torch.multiprocessing.get_context('spawn').Pool(shards) as pool:
+        pool.starmap(caption_a2c_shard, shard_args)
+    merge_caption_results(shard_paths, results_path)
+
+
+def caption_a2c_shard(a2c_network, captions_real_all, features_real_all, urls_all, idx_to_word, results_path,
+                      validation_batch_size=128, threads=None, show_progress=True, mixed_precision=False):
+    """
+    Generate captions for a set of test items and write them with the real captions and urls to results_path
+    @param a2c_network: the a2c network
+    @param captions_real_all: real captions of the items
+    @param features_real_all: image features of the items
+    @param urls_all: image urls of the items
+    @param idx_to_word: vocab to decode the captions
+    @param results_path: path of the results file
+    @param validation_batch_size: batch size to caption the items
+    @param threads: (optional) number of threads torch may use in this process
+    @param show_progress: whether to show a progress bar
+    @param mixed_precision: whether to autocast the forward passes (see MixedPrecision)
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
 
-        for i in tqdm(range(0, val_captions_lens, validation_batch_size), desc='Testing model'):
-            features_real = features_real_all[i:i + validation_batch_size - 1]
-            captions_real = captions_real_all[i:i + validation_batch_size - 1]
-            urls = urls_all[i:i + validation_batch_size - 1]
+    precision = MixedPrecision(mixed_precision)
+    with torch.no_grad(), precision.autocast():
+        a2c_network.train(False)
+        val_captions_lens = len(captions_real_all)
 
-            gen_cap = GenerateCaptionsWithActorCriticLookAhead(features_real, captions_real, a2c_network.policy_network,
-                                                               a2c_network.value_network, most_likely=True)
-            gen_cap_str = decode_captions(gen_cap, idx_to_word=test_data["idx_to_word"])
-            real_cap_str = decode_captions(captions_real, idx_to_word=test_data["idx_to_word"])
+        with CaptionResultsWriter(results_path) as results_writer:
+            for i in tqdm(range(0, val_captions_lens, validation_batch_size), desc='Testing model',
+                          disable=not show_progress):
+                features_real = features_real_all[i:i + validation_batch_size]
+                captions_real = captions_real_all[i:i + validation_batch_size]
+                urls = urls_all[i:i + validation_batch_size]
 
-            real_captions_file.write("\n".join(real_cap_str))
-            generated_captions_file.write("\n".join(gen_cap_str))
-            image_url_file.write("\n".join(urls))
+                gen_cap = GenerateCaptionsWithActorCriticLookAhead(features_real, captions_real,
+                                                                   a2c_network.policy_network,
+                                                                   a2c_network.value_network, most_likely=True)
+                gen_cap_str = decode_captions(gen_cap, idx_to_word=idx_to_word)
+                real_cap_str = decode_captions(captions_real, idx_to_word=idx_to_word)
 
-            real_captions_file.flush()
-            generated_captions_file.flush()
-            image_url_file.flush()
+                results_writer.write(real_cap_str, gen_cap_str, urls)
 
-            # a2c_network.value_network.valrnn.hidden_cell = repackage_hidden(a2c_network.value_network.valrnn.hidden_cell)
-            a2c_network.value_network.valrnn.init_hidden()
 
-        real_captions_file.close()
-        generated_captions_file.close()
-        image_url_file.close()
+def check_mixed_precision(a2c_network, test_data, precision, data_size=512, validation_batch_size=128):
+    """
+    Compare the outputs of the a2c network in mixed precision with the float32 reference outputs,
+    on the first data_size items of the val split
+    @param a2c_network: the a2c network
+    @param test_data: the dataset for testing
+    @param precision: the MixedPrecision to check
+    @param data_size: number of val items to compare on
+    @param validation_batch_size: batch size to sample the data
+    @return: dict of the differences of the policy and value outputs, the agreement of the generated captions
+    and the scores of the float32 and the mixed precision captions
+    """
+    captions_all, features_all, _ = get_coco_shard(test_data, 0, 1, split='val')
+    captions_all, features_all = captions_all[:data_size], features_all[:data_size]
+    policy_network, value_network = a2c_network.policy_network, a2c_network.value_network
+    a2c_network.train(False)
+
+    logits_diff, value_diff, word_agreement = 0.0, 0.0, []
+    refs, hypo_fp32, hypo_mixed = {}, {}, {}
+    caption_agreement = []
+    with torch.no_grad():
+        for i in range(0, len(captions_all), validation_batch_size):
+            captions = torch.as_tensor(captions_all[i:i + validation_batch_size], device=device).long()
+            features = torch.as_tensor(features_all[i:i + validation_batch_size], device=device).float()
+
+            outputs = []
+            for enabled in [False, True]:
+                with torch.autocast(device.type, dtype=precision.dtype, enabled=enabled):
+                    logits = policy_network(features.unsqueeze(0), captions[:, :-1])
+                    values = value_network(features, captions)
+                    gen_caps = GenerateCaptionsWithActorCriticLookAhead(features, captions, policy_network,
+                                                                        value_network, most_likely=True)
+                outputs.append((logits.float(), values.float(), gen_caps))
+            (logits, values, gen_caps), (logits_mp, values_mp, gen_caps_mp) = outputs
+
+            logits_diff = max(logits_diff, (logits - logits_mp).abs().max().item())
+            value_diff = max(value_diff, (values - values_mp).abs().max().item())
+            word_agreement.append((logits.argmax(2) == logits_mp.argmax(2)).float().mean().item())
+            caption_agreement.append((gen_caps == gen_caps_mp).all(1).float().mean().item())
+
+            for j, (real, gen, gen_mp) in enumerate(zip(decode_captions(captions, test_data["idx_to_word"]),
+                                                        decode_captions(gen_caps, test_data["idx_to_word"]),
+                                                        decode_captions(gen_caps_mp, test_data["idx_to_word"]))):
+                # scored without the special tokens, like the test results (see load_caption_results)
+                refs[i + j] = [remove_special_tokens(real).strip()]
+                hypo_fp32[i + j] = [remove_special_tokens(gen).strip()]
+                hypo_mixed[i + j] = [remove_special_tokens(gen_mp).strip()]
+
+    score_fp32 = fast_score(refs, hypo_fp32)
+    score_mixed = fast_score(refs, hypo_mixed)
+    report = {
+        "policy_logits_max_abs_diff": logits_diff,
+        "value_max_abs_diff": value_diff,
+        "next_word_agreement": float(np.mean(word_agreement)),
+        "caption_exact_match": float(np.mean(caption_agreement)),
+    }
+    for method in score_fp32:
+        report[method + "_fp32"] = float(score_fp32[method])
+        report[method + "_mixed"] = float(score_mixed[method])
+    return report
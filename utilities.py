@@ -11,11 +11,22 @@
 
 import h5py
 import json
+import hashlib
+import shutil
 import requests
 import gc
+import glob
+import re
+import math
+import random
+import queue
+import threading
+import time
+import torch.distributed as dist
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from PIL import Image
 from io import BytesIO
-import urllib.request
 import gensim
 import gensim.downloader as api
 from gensim.models import KeyedVectors
@@ -42,35 +53,115 @@ def print_red(text):
     print('\033[31m', text, '\033[0m', sep='')
 
 
-def load_data(base_dir, max_train=None, pca_features=True, print_keys=False):
+MMAP_MANIFEST_FILE = 'manifest.json'  # lists the .npy files converted from each HDF5 file, and its size and mtime
+MMAP_CHUNK_ROWS = 8192  # rows copied at a time while converting, keeps conversion memory bounded
+
+
+def get_h5_files(pca_features=True):
+    """
+    HDF5 files of the dataset and the data keys stored in them
+    @param pca_features: whether to use the features with PCA applied
+    @return: list of tuples (file name, dict of data key -> HDF5 dataset name), None maps every dataset to itself
+    """
+    if pca_features:
+        train_feat_file, val_feat_file = 'train2014_vgg16_fc7_pca.h5', 'val2014_vgg16_fc7_pca.h5'
+    else:
+        train_feat_file, val_feat_file = 'train2014_vgg16_fc7.h5', 'val2014_vgg16_fc7.h5'
+
+    return [
+        ('coco2014_captions.h5', None),
+        (train_feat_file, {'train_features': 'features'}),
+        (val_feat_file, {'val_features': 'features'}),
+    ]
+
+
+def convert_h5_to_npy(h5_path, mmap_dir, keys=None):
+    """
+    Copy the datasets of an HDF5 file into .npy files that can be memory-mapped
+    @param h5_path: the HDF5 file to convert
+    @param mmap_dir: dir where the .npy files are written
+    @param keys: dict of data key -> HDF5 dataset name, None to convert every dataset under its own name
+    @return: dict of data key -> .npy file name
+    """
+    base_name = os.path.splitext(os.path.basename(h5_path))[0]
+    converted = {}
+    with h5py.File(h5_path, 'r') as f:
+        if keys is None:
+            keys = {k: k for k in f.keys()}
+        for key, dataset_name in keys.items():
+            dataset = f[dataset_name]
+            npy_name = '%s.%s.npy' % (base_name, key)
+            # processes sharing mmap_dir may convert the same file at once, each writes its own temp file
+            tmp_path = os.path.join(mmap_dir, '%s.tmp-%d' % (npy_name, os.getpid()))
+
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dataset.dtype, shape=dataset.shape)
+            for i in range(0, dataset.shape[0], MMAP_CHUNK_ROWS):
+                out[i:i + MMAP_CHUNK_ROWS] = dataset[i:i + MMAP_CHUNK_ROWS]
+            out.flush()
+            del out
+            os.replace(tmp_path, os.path.join(mmap_dir, npy_name))
+
+            converted[key] = npy_name
+    return converted
+
+
+def load_mmap_arrays(base_dir, mmap_dir, pca_features=True):
+    """
+    Memory-map the dataset arrays from mmap_dir, converting the HDF5 files on first use.
+    The arrays are served from the page cache, so processes using the same mmap_dir share one copy.
+    @param base_dir: dir where the HDF5 dataset is stored
+    @param mmap_dir: dir of the converted .npy files
+    @param pca_features: whether to load features with PCA applied
+    @return: dict of read-only memory-mapped arrays
+    """
+    os.makedirs(mmap_dir, exist_ok=True)
+    manifest_path = os.path.join(mmap_dir, MMAP_MANIFEST_FILE)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    arrays = {}
+    for h5_name, keys in get_h5_files(pca_features):
+        h5_path = os.path.join(base_dir, h5_name)
+        h5_stat = os.stat(h5_path)
+        source = {"size": h5_stat.st_size, "mtime": h5_stat.st_mtime}
+        if h5_name not in manifest or manifest[h5_name].get("source") != source:
+            # converted for the first time, or the HDF5 file changed since its conversion
+            print_green(f'[Info] Converting {h5_name} to memory-mappable arrays in {mmap_dir}')
+            manifest[h5_name] = {"source": source, "arrays": convert_h5_to_npy(h5_path, mmap_dir, keys)}
+            # the manifest is only updated once the conversion is complete
+            tmp_path = '%s.tmp-%d' % (manifest_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_path, manifest_path)
+
+        for key, npy_name in manifest[h5_name]["arrays"].items():
+            arrays[key] = np.load(os.path.join(mmap_dir, npy_name), mmap_mode='r')
+    return arrays
+
+
+def load_data(base_dir, max_train=None, pca_features=True, print_keys=False, mmap_dir=None):
     """
     Load the COCO dataset in memory
     @param base_dir: dir where the dataset is stored
     @param max_train: load given size of data, pass None to load full data
     @param pca_features: whether to load data with PCA applied
     @param print_keys: whether to print components of the dataset
+    @param mmap_dir: (optional) memory-map the arrays from this dir instead of reading them in memory
     @return: dict:data with dataset loaded
     """
     data = {}
 
-    caption_file = os.path.join(base_dir, 'coco2014_captions.h5')
-    with h5py.File(caption_file, 'r') as f:
-        for k, v in f.items():
-            data[k] = np.asarray(v)
-
-    if pca_features:
-        train_feat_file = os.path.join(base_dir, 'train2014_vgg16_fc7_pca.h5')
-    else:
-        train_feat_file = os.path.join(base_dir, 'train2014_vgg16_fc7.h5')
-    with h5py.File(train_feat_file, 'r') as f:
-        data['train_features'] = np.asarray(f['features'])
-
-    if pca_features:
-        val_feat_file = os.path.join(base_dir, 'val2014_vgg16_fc7_pca.h5')
+    if mmap_dir is not None:
+        data.update(load_mmap_arrays(base_dir, mmap_dir, pca_features))
     else:
-        val_feat_file = os.path.join(base_dir, 'val2014_vgg16_fc7.h5')
-    with h5py.File(val_feat_file, 'r') as f:
-        data['val_features'] = np.asarray(f['features'])
+        for h5_name, keys in get_h5_files(pca_features):
+            with h5py.File(os.path.join(base_dir, h5_name), 'r') as f:
+                if keys is None:
+                    keys = {k: k for k in f.keys()}
+                for key, dataset_name in keys.items():
+                    data[key] = np.asarray(f[dataset_name])
 
     dict_file = os.path.join(base_dir, 'coco2014_vocab.json')
     with open(dict_file, 'r') as f:
@@ -95,17 +186,13 @@ def load_data(base_dir, max_train=None, pca_features=True, print_keys=False):
         data['train_captions'] = data['train_captions'][mask]
         data['train_image_idxs'] = data['train_image_idxs'][mask]
 
-    data["train_captions_lens"] = np.zeros(data["train_captions"].shape[0])
-    data["val_captions_lens"] = np.zeros(data["val_captions"].shape[0])
-    for i in range(data["train_captions"].shape[0]):
-        data["train_captions_lens"][i] = np.nonzero(data["train_captions"][i] == 2)[0][0] + 1
-    for i in range(data["val_captions"].shape[0]):
-        data["val_captions_lens"][i] = np.nonzero(data["val_captions"][i] == 2)[0][0] + 1
+    data["train_captions_lens"] = get_captions_lens(data["train_captions"])
+    data["val_captions_lens"] = get_captions_lens(data["val_captions"])
 
     if print_keys:
         # Print out all the keys and values from the data dictionary
         for k, v in data.items():
-            if type(v) == np.ndarray:
+            if isinstance(v, np.ndarray):
                 print(k, type(v), v.shape, v.dtype)
             else:
                 print(k, type(v), len(v))
@@ -113,6 +200,17 @@ def load_data(base_dir, max_train=None, pca_features=True, print_keys=False):
     return data
 
 
+def get_captions_lens(captions):
+    """
+    Length of every caption, up to and including the first <END> token, T for captions without <END>
+    @param captions: (N, T) array of caption tokens
+    @return: (N,) array of caption lengths
+    """
+    # '2' is the end of segment, argmax over the mask finds its first occurrence
+    is_end = np.asarray(captions) == 2
+    return np.where(is_end.any(axis=1), np.argmax(is_end, axis=1) + 1, is_end.shape[1])
+
+
 def decode_captions(captions, idx_to_word):
     """
     Decode the captions from the emebbedings
@@ -120,21 +218,28 @@ def decode_captions(captions, idx_to_word):
     @param idx_to_word: dectionary used for decoding
     @return: decoded captions
     """
+    if torch.is_tensor(captions):
+        captions = captions.cpu().numpy()
+    captions = np.asarray(captions)
+
     singleton = False
     if captions.ndim == 1:
         singleton = True
         captions = captions[None]
-    decoded = []
-    N, T = captions.shape
-    for i in range(N):
-        words = []
-        for t in range(T):
-            word = idx_to_word[captions[i, t]]
-            if word != '<NULL>':
-                words.append(word)
-            if word == '<END>':
-                break
-        decoded.append(' '.join(words))
+
+    if isinstance(idx_to_word, dict):
+        vocab = np.empty(max(idx_to_word.keys()) + 1, dtype=object)
+        for i, w in idx_to_word.items():
+            vocab[i] = w
+    else:
+        vocab = np.asarray(idx_to_word, dtype=object)
+
+    words = vocab[captions]
+    is_end = (vocab == '<END>')[captions]
+    # drop <NULL> tokens and everything after the first <END>
+    keep = (np.cumsum(is_end, axis=1) - is_end == 0) & ~(vocab == '<NULL>')[captions]
+    decoded = [' '.join(w[k]) for w, k in zip(words, keep)]
+
     if singleton:
         decoded = decoded[0]
     return decoded
@@ -157,25 +262,247 @@ def get_coco_batch(data, batch_size=100, split='train'):
     return captions, image_features, urls
 
 
-def get_coco_minibatches(data, batch_size=100, split='train'):
+def get_coco_minibatches(data, batch_size=100, split='train', with_lens=False, generator=None, rank=0, world_size=1,
+                         start=0):
     """
     Sample batch_size of data, to be used in train and testing loop with iterator
     @param data: the main dataset
     @param batch_size: size of batch to sample
     @param split: whether to load train or val set
-    @return: yield a tuple of captions, image_features, urls
+    @param with_lens: whether to also yield the precomputed caption lengths
+    @param generator: (optional) torch.Generator used to shuffle the data
+    @param rank: index of this process among the data-parallel processes
+    @param world_size: number of data-parallel processes, each one gets every world_size-th batch
+    @param start: number of batches of this process to skip, to resume an interrupted pass
+    @return: yield a tuple of captions, image_features, urls (and caption lengths if with_lens is set)
     """
     split_total_size = data['%s_captions' % split].shape[0]
-    permutation = torch.randperm(split_total_size)
+    permutation = torch.randperm(split_total_size, generator=generator).numpy()
 
-    for i in range(0, split_total_size, batch_size):
+    for i in shard_minibatches(range(0, split_total_size, batch_size), rank, world_size)[start:]:
         mask = permutation[i: i + batch_size]
         captions = data['%s_captions' % split][mask]
         image_idxs = data['%s_image_idxs' % split][mask]
         image_features = data['%s_features' % split][image_idxs]
         urls = data['%s_urls' % split][image_idxs]
 
-        yield captions, image_features, urls
+        if with_lens:
+            yield captions, image_features, urls, data['%s_captions_lens' % split][mask]
+        else:
+            yield captions, image_features, urls
+
+
+def get_coco_bucketed_minibatches(data, batch_size=100, split='train', with_lens=False, generator=None, rank=0,
+                                  world_size=1, start=0):
+    """
+    Sample batch_size of data grouped by caption length. Every batch only holds captions of one length and is
+    trimmed to it, so no RNN step is spent on padding. Batch membership and order are reshuffled on every call.
+    @param data: the main dataset
+    @param batch_size: size of batch to sample
+    @param split: whether to load train or val set
+    @param with_lens: whether to also yield the precomputed caption lengths
+    @param generator: (optional) torch.Generator used to shuffle the data
+    @param rank: index of this process among the data-parallel processes
+    @param world_size: number of data-parallel processes, each one gets every world_size-th batch
+    @param start: number of batches of this process to skip, to resume an interrupted pass
+    @return: yield a tuple of captions, image_features, urls (and caption lengths if with_lens is set)
+    """
+    lens = data['%s_captions_lens' % split].astype(np.int64)
+    permutation = torch.randperm(lens.shape[0], generator=generator).numpy()
+
+    # stable sort of a random permutation: grouped by length, still shuffled within each length
+    order = permutation[np.argsort(lens[permutation], kind='stable')]
+    buckets = np.split(order, np.flatnonzero(np.diff(lens[order])) + 1)
+    batches = [bucket[i: i + batch_size] for bucket in buckets for i in range(0, bucket.shape[0], batch_size)]
+
+    for b in shard_minibatches(torch.randperm(len(batches), generator=generator).tolist(), rank, world_size)[start:]:
+        mask = batches[b]
+        max_len = lens[mask].max()
+        captions = data['%s_captions' % split][mask][:, :max_len]
+        image_idxs = data['%s_image_idxs' % split][mask]
+        image_features = data['%s_features' % split][image_idxs]
+        urls = data['%s_urls' % split][image_idxs]
+
+        if with_lens:
+            yield captions, image_features, urls, lens[mask]
+        else:
+            yield captions, image_features, urls
+
+
+def shard_minibatches(minibatches, rank, world_size):
+    """
+    Every world_size-th minibatch, starting at rank. The minibatches that can't be spread evenly are dropped, so
+    that every data-parallel process runs the same number of steps.
+    @param minibatches: list of all the minibatches (or their ids)
+    @param rank: index of this process among the data-parallel processes
+    @param world_size: number of data-parallel processes
+    @return: the minibatches of this process
+    """
+    if world_size == 1:
+        return minibatches
+    return minibatches[rank: len(minibatches) // world_size * world_size: world_size]
+
+
+def count_coco_minibatches(data, batch_size=100, split='train', bucketed=False, world_size=1):
+    """
+    Number of minibatches in one pass over the split
+    @param data: the main dataset
+    @param batch_size: size of batch to sample
+    @param split: whether to count the train or val set
+    @param bucketed: whether batches are grouped by caption length (see get_coco_bucketed_minibatches)
+    @param world_size: number of data-parallel processes the minibatches are spread over
+    @return: number of minibatches (of each process)
+    """
+    if not bucketed:
+        return math.ceil(data['%s_captions' % split].shape[0] / batch_size) // world_size
+    bucket_sizes = np.bincount(data['%s_captions_lens' % split].astype(np.int64))
+    return int(np.sum(np.ceil(bucket_sizes / batch_size))) // world_size
+
+
+def prefetch_coco_minibatches(data, batch_size=100, split='train', with_lens=False, queue_size=4, bucketed=False,
+                              generator=None, rank=0, world_size=1, start=0):
+    """
+    Same batches as get_coco_minibatches, gathered in a background thread and handed over as tensors already on
+    the device, so data gathering, dtype conversion and host-to-device copies overlap with the model
+    @param data: the main dataset
+    @param batch_size: size of batch to sample
+    @param split: whether to load train or val set
+    @param with_lens: whether to also yield the precomputed caption lengths
+    @param queue_size: max number of batches prepared ahead of the training loop
+    @param bucketed: whether to group batches by caption length (see get_coco_bucketed_minibatches)
+    @param generator: (optional) torch.Generator used to shuffle the data
+    @param rank: index of this process among the data-parallel processes
+    @param world_size: number of data-parallel processes, each one gets every world_size-th batch
+    @param start: number of batches of this process to skip, to resume an interrupted pass
+    @return: yield a tuple of captions (long), image_features (float), urls (and caption lengths (long) if with_lens)
+    """
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    pin_memory = device.type == 'cuda'
+    end_of_data = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    minibatches = get_coco_bucketed_minibatches if bucketed else get_coco_minibatches
+
+    def produce():
+        try:
+            for minibatch in minibatches(data, batch_size=batch_size, split=split, with_lens=with_lens,
+                                         generator=generator, rank=rank, world_size=world_size, start=start):
+                captions, features, urls = minibatch[:3]
+                tensors = [torch.from_numpy(np.asarray(captions, dtype=np.int64)),
+                           torch.from_numpy(np.asarray(features, dtype=np.float32))]
+                if with_lens:
+                    tensors.append(torch.from_numpy(np.asarray(minibatch[3], dtype=np.int64)))
+                if pin_memory:
+                    tensors = [t.pin_memory() for t in tensors]
+                if not put((tensors, urls)):
+                    return
+            put(end_of_data)
+        except Exception as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is end_of_data:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            tensors, urls = item
+            tensors = [t.to(device, non_blocking=True) for t in tensors]
+            if with_lens:
+                yield tensors[0], tensors[1], urls, tensors[2]
+            else:
+                yield tensors[0], tensors[1], urls
+    finally:
+        stop.set()
+        producer.join()
+
+
+def get_rank():
+    """
+    @return: index of this process among the data-parallel processes, 0 when not training data-parallel
+    """
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    """
+    @return: number of data-parallel processes, 1 when not training data-parallel
+    """
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def is_main_process():
+    """
+    @return: whether this process saves the networks and writes the logs
+    """
+    return get_rank() == 0
+
+
+def get_shared_generator():
+    """
+    @return: torch.Generator used to shuffle the data, seeded from the global generator. It is seeded the same in
+    every data-parallel process, so that they all shuffle the data the same way and can split the minibatches
+    among them. Its state at the start of an epoch is enough to replay the epoch's permutation when resuming.
+    """
+    seed = torch.randint(2 ** 62, (1,))
+    if get_world_size() > 1:
+        dist.broadcast(seed, 0)
+    generator = torch.Generator()
+    generator.manual_seed(int(seed))
+    return generator
+
+
+def broadcast_parameters(module):
+    """
+    Copy the parameters and buffers of the main process's module to the other data-parallel processes
+    @param module: the network
+    """
+    if get_world_size() == 1:
+        return
+    with torch.no_grad():
+        for tensor in module.state_dict().values():
+            dist.broadcast(tensor, 0)
+
+
+def allreduce_gradients(module, contributes=True):
+    """
+    Average the gradients of the module over the data-parallel processes, in a single all-reduce.
+    Processes that skipped the minibatch call it with contributes=False, and are left out of the average.
+    @param module: the network
+    @param contributes: whether this process computed gradients for the current minibatch
+    @return: number of processes that contributed gradients, the optimizer should only step if it is not 0
+    """
+    if get_world_size() == 1:
+        return int(contributes)
+
+    params = [p for p in module.parameters() if p.requires_grad]
+    grads = [p.grad.reshape(-1) if contributes and p.grad is not None else torch.zeros(p.numel(), device=p.device)
+             for p in params]
+    contributors = torch.ones(1, device=params[0].device) if contributes else torch.zeros(1, device=params[0].device)
+    flat = torch.cat(grads + [contributors])
+    dist.all_reduce(flat)
+
+    count = int(flat[-1].item())
+    if count > 0:
+        flat /= count
+    offset = 0
+    for p in params:
+        p.grad = flat[offset: offset + p.numel()].view_as(p).clone()
+        offset += p.numel()
+    return count
 
 
 def get_coco_validation_data(data):
@@ -190,15 +517,139 @@ def get_coco_validation_data(data):
     return captions, image_features, urls
 
 
-def image_from_url(url):
+def get_coco_shard(data, shard, num_shards, split='val'):
+    """
+    Get one of num_shards contiguous shards of a split, in dataset order. The shards cover every item of the
+    split exactly once.
+    @param data: the main dataset
+    @param shard: index of the shard
+    @param num_shards: number of shards
+    @param split: whether to load train or val set
+    @return: tuple of captions, image_features, urls
+    """
+    split_total_size = data['%s_captions' % split].shape[0]
+    mask = np.array_split(np.arange(split_total_size), num_shards)[shard]
+    captions = data['%s_captions' % split][mask]
+    image_idxs = data['%s_image_idxs' % split][mask]
+    image_features = data['%s_features' % split][image_idxs]
+    urls = data['%s_urls' % split][image_idxs]
+    return captions, image_features, urls
+
+
+IMAGE_CACHE_DIR = os.path.join('datasets', 'image_cache')  # downloaded images are cached here, keyed by url
+
+
+class ImageFetcher:
+    """
+    Downloads images with a connection-pooled session and a bounded thread pool, retrying failed requests
+    with exponential backoff. Every image is stored once in a content-addressed cache keyed by its url,
+    so an image that was already fetched is never downloaded again.
+    """
+
+    def __init__(self, cache_dir=IMAGE_CACHE_DIR, max_workers=8, retries=3, backoff=0.5, timeout=30):
+        """
+
+        @param cache_dir: dir of the image cache
+        @param max_workers: max number of concurrent downloads (and pooled connections per host)
+        @param retries: number of retries of a failed download
+        @param backoff: delay before the first retry in seconds, doubled on every retry
+        @param timeout: timeout of a request in seconds
+        """
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def cache_path(self, url):
+        """
+        @param url: web url of image
+        @return: path of the cached image
+        """
+        url = url.strip()
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def fetch(self, url):
+        """
+        Download the image given by url, unless it is cached already
+        @param url: web url of image
+        @return: path of the cached image
+        """
+        path = self.cache_path(url)
+        if os.path.isfile(path):
+            return path
+
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(url.strip(), timeout=self.timeout)
+                response.raise_for_status()
+                break
+            except requests.RequestException as e:
+                # client errors other than throttling won't get better by retrying
+                status = e.response.status_code if e.response is not None else None
+                if (status is not None and 400 <= status < 500 and status != 429) or attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * (2 ** attempt))
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = '%s.tmp-%d-%d' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(tmp_path, path)
+        return path
+
+    def fetch_all(self, urls):
+        """
+        Download the images given by urls concurrently
+        @param urls: list of web urls
+        @return: list of the paths of the cached images, None for the ones that failed
+        """
+        def fetch_or_none(url):
+            try:
+                return self.fetch(url)
+            except Exception as e:
+                print(f'downloading {url.strip()} failed with {e}')
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(fetch_or_none, urls))
+
+    def open(self, url):
+        """
+        @param url: web url of image
+        @return: Image object
+        """
+        return Image.open(self.fetch(url))
+
+
+default_image_fetcher = None
+
+
+def get_image_fetcher():
+    """
+    @return: the ImageFetcher shared by image_from_url and post_process_data
+    """
+    global default_image_fetcher
+    if default_image_fetcher is None:
+        default_image_fetcher = ImageFetcher()
+    return default_image_fetcher
+
+
+def image_from_url(url, image_fetcher=None):
     """
     Download the image given by url
     @param url: web url of image
+    @param image_fetcher: (optional) ImageFetcher to use, defaults to the shared one
     @return: Image object
     """
-    response = requests.get(url)
-    img = Image.open(BytesIO(response.content))
-    return img
+    if image_fetcher is None:
+        image_fetcher = get_image_fetcher()
+    return image_fetcher.open(url)
 
 
 def global_minibatch_number(epoch, batch_id, batch_size):
@@ -226,61 +677,152 @@ def print_garbage_collection():
     print("-" * 30)
 
 
-def post_process_data(image_caption_data, top_item_count=5):
+CAPTION_RESULTS_BUFFER_SIZE = 1 << 20  # bytes buffered by CaptionResultsWriter between writes to disk
+
+
+class CaptionResultsWriter:
+    """
+    Results sink of test_a2c_network. Each item is written as one JSON record holding its real caption,
+    generated caption and image url, one record per line. Writes go to a temporary file through a large
+    buffer, and close() renames it into place, so readers only ever see a complete results file.
+    """
+
+    def __init__(self, path, buffer_size=CAPTION_RESULTS_BUFFER_SIZE):
+        """
+
+        @param path: path of the results file
+        @param buffer_size: size of the write buffer in bytes
+        """
+        self.path = path
+        self.tmp_path = '%s.tmp-%d' % (path, os.getpid())
+        self.file = open(self.tmp_path, 'w', buffering=buffer_size)
+        self.count = 0
+
+    def write(self, real_captions, generated_captions, urls):
+        """
+        append a batch of results
+        @param real_captions: list of real captions
+        @param generated_captions: list of generated captions
+        @param urls: list of image urls
+        """
+        if not len(real_captions) == len(generated_captions) == len(urls):
+            raise ValueError("Mismatched results batch", len(real_captions), len(generated_captions), len(urls))
+        self.file.write(''.join(json.dumps({"real": r.strip(), "generated": g.strip(), "url": u.strip()}) + '\n'
+                                for r, g, u in zip(real_captions, generated_captions, urls)))
+        self.count += len(urls)
+
+    def close(self):
+        """
+        flush the results and move the file into place
+        """
+        if self.file.closed:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        drop the results written so far
+        """
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_caption_results(path):
+    """
+    stream the records of a results file written by CaptionResultsWriter
+    @param path: path of the results file
+    @return: generator of dicts with keys "real", "generated" and "url"
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_caption_results(path, keep_special_tokens=False):
+    """
+    @param path: path of the results file written by CaptionResultsWriter
+    @param keep_special_tokens: keep the <START>, <END> and <UNK> tokens of the captions, they are removed
+                                before scoring otherwise (see load_textfiles)
+    @return: refs and hypo dicts in the format of the scorers, list of image urls
+    """
+    refs, hypo, urls = {}, {}, []
+    for idx, record in enumerate(read_caption_results(path)):
+        real, generated = record["real"], record["generated"]
+        if not keep_special_tokens:
+            real, generated = remove_special_tokens(real).strip(), remove_special_tokens(generated).strip()
+        refs[idx] = [real]
+        hypo[idx] = [generated]
+        urls.append(record["url"])
+    return refs, hypo, urls
+
+
+def merge_caption_results(shard_paths, path):
+    """
+    concatenate results files written by CaptionResultsWriter, in the given order, and remove them
+    @param shard_paths: list of paths of the results files to merge
+    @param path: path of the merged results file
+    """
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as out:
+        for shard_path in shard_paths:
+            with open(shard_path, 'rb') as f:
+                shutil.copyfileobj(f, out, CAPTION_RESULTS_BUFFER_SIZE)
+    os.replace(tmp_path, path)
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+
+
+def post_process_data(image_caption_data, top_item_count=5, image_fetcher=None):
     """
     compare actual and generated caption by scoring each line. sort the results and
     get top_item_count number of elements. Download images for top elements and save results.
     @param image_caption_data: dict of various path
     @param top_item_count: number of items to get with top score
+    @param image_fetcher: (optional) ImageFetcher used to download the images, defaults to the shared one
     """
-    score_list = []
-
-    real_captions_filename = image_caption_data["real_captions_path"]
-    generated_captions_filename = image_caption_data["generated_captions_path"]
-    image_url_filename = image_caption_data["image_urls_path"]
+    caption_results_filename = image_caption_data["caption_results_path"]
     best_score_file_path = image_caption_data["best_score_file_path"]
     best_score_images_path = image_caption_data["best_score_images_path"]
 
-    real_captions_file = open(real_captions_filename, "r")
-    generated_captions_file = open(generated_captions_filename, "r")
-    image_url_file = open(image_url_filename, "r")
-    best_score_file = open(best_score_file_path, "w")
-
-    real_captions_lines = real_captions_file.readlines()
-    generated_captions_lines = generated_captions_file.readlines()
-    image_url_lines = image_url_file.readlines()
-    data_len = len(real_captions_lines)
-
-    for i in tqdm(range(data_len), desc='Comparing scores'):
-        s = get_singleton_score(real_captions_lines[i], generated_captions_lines[i])
-        avg = 0.0
-        for k in s.keys():
-            avg += s[k]
-        avg /= len(s.keys())
-        score_list.append(avg)
-
-    arr = np.array(score_list)
+    refs, hypo, image_urls = load_caption_results(caption_results_filename, keep_special_tokens=True)
+    data_len = len(refs)
+    print_green(f'[Info] Comparing scores of {data_len} captions')
+    sentence_scores = score_per_sentence(refs, hypo)
+
+    arr = np.mean(np.stack(list(sentence_scores.values())), axis=0)
+    score_list = arr.tolist()
     top_items_index = arr.argsort()[::-1][:top_item_count]
 
     if not os.path.isdir(best_score_images_path):
         os.mkdir(best_score_images_path)
 
-    for i in tqdm(top_items_index, desc='Downloading images'):
-        buff = 'item_index[%d] score:[%f] real_cap:[%s] generated_cap:[%s] \n' % (
-            i + 1, score_list[i], real_captions_lines[i].strip(), generated_captions_lines[i].strip())
-        best_score_file.write(buff)
-        try:
-            i_name = "%d.jpg" % (i + 1)
-            i_name = str(os.path.join(best_score_images_path, i_name))
-            urllib.request.urlretrieve(image_url_lines[i], i_name)
-        except:
-            e = sys.exc_info()[0]
-            print(f'downloading {image_url_lines[i]} failed with {e}')
+    if image_fetcher is None:
+        image_fetcher = get_image_fetcher()
+    print_green(f'[Info] Downloading {len(top_items_index)} images')
+    image_paths = image_fetcher.fetch_all([image_urls[i] for i in top_items_index])
 
-    real_captions_file.close()
-    generated_captions_file.close()
-    image_url_file.close()
-    best_score_file.close()
+    with open(best_score_file_path, "w") as best_score_file:
+        for i, image_path in zip(top_items_index, image_paths):
+            buff = 'item_index[%d] score:[%f] real_cap:[%s] generated_cap:[%s] \n' % (
+                i + 1, score_list[i], refs[i][0], hypo[i][0])
+            best_score_file.write(buff)
+            if image_path is not None:
+                i_name = "%d.jpg" % (i + 1)
+                shutil.copyfile(image_path, os.path.join(best_score_images_path, i_name))
 
 
 def save_a2c_model(model, save_paths):
@@ -289,11 +831,181 @@ def save_a2c_model(model, save_paths):
     @param model: model to save
     @param save_paths: path where to save
     """
-    if isinstance(save_paths, list):
-        for path in save_paths:
-            save(model.state_dict(), path)
-    elif isinstance(save_paths, str):
-        save(model.state_dict(), save_paths)
+    write_checkpoint(serialize_state_dict(model.state_dict()), save_paths)
+
+
+def serialize_state_dict(state_dict):
+    """
+    @param state_dict: the weights to save
+    @return: bytes of the weights in the format of torch.save
+    """
+    buffer = BytesIO()
+    save(state_dict, buffer)
+    return buffer.getvalue()
+
+
+def write_checkpoint(data, save_paths):
+    """
+    write serialized weights to every path. Each file is written under a temporary name and renamed into place,
+    so a reader never sees a partially written checkpoint.
+    @param data: bytes of the weights (see serialize_state_dict)
+    @param save_paths: path, or list of paths, where to save
+    """
+    if isinstance(save_paths, str):
+        save_paths = [save_paths]
+    for path in save_paths:
+        tmp_path = '%s.tmp-%d' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def snapshot_to_host(obj):
+    """
+    @param obj: tensor, or dict / list / tuple holding tensors (e.g. a state_dict or an optimizer state)
+    @return: the same structure with copies of the tensors in host memory
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_to_host(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_host(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    """
+    @return: dict of the states of the torch, cuda, numpy and python random generators
+    """
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+    restore the random generators
+    @param state: dict returned by get_rng_state
+    """
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+CHECKPOINT_MIN_INTERVAL = 30.0  # min seconds between two best-loss checkpoints of the pretrained networks
+CHECKPOINT_KEEP_LAST = 3  # number of per-epoch A2C checkpoints kept next to the latest one
+
+
+class CheckpointManager:
+    """
+    Saves checkpoints without stalling the training loop. save() copies the weights to host memory and returns,
+    a background thread serializes them once and writes them, in order, to every path with an atomic rename.
+    Saves are throttled: a save that comes less than min_interval seconds or min_steps steps after the last
+    written one is held back, and only the latest held back weights are written, once the throttle allows it
+    or on close(). With keep_last > 0, a copy of each checkpoint is also kept next to the first save path, which
+    should be in the run's own dir, under a name tagged with its step, and only the last keep_last of those are kept.
+    """
+
+    def __init__(self, save_paths, min_interval=0.0, min_steps=0, keep_last=0):
+        """
+
+        @param save_paths: path, or list of paths, where to save, the step-tagged copies go next to the first one
+        @param min_interval: min number of seconds between two written checkpoints
+        @param min_steps: min number of steps between two written checkpoints
+        @param keep_last: number of step-tagged checkpoints to keep, 0 to only keep the latest one
+        """
+        self.save_paths = [save_paths] if isinstance(save_paths, str) else list(save_paths)
+        self.min_interval = min_interval
+        self.min_steps = min_steps
+        self.keep_last = keep_last
+
+        self.last_time = None
+        self.last_step = None
+        self.held = None
+        self.pending = []
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def save(self, state_dict, step, force=False):
+        """
+        snapshot the weights and queue them for writing
+        @param state_dict: the weights (or any dict of tensors and python objects) to save
+        @param step: training step of the weights
+        @param force: whether to ignore the throttle
+        """
+        self.raise_error()
+        snapshot = snapshot_to_host(state_dict)
+        now = time.monotonic()
+        throttled = self.last_time is not None and (now - self.last_time < self.min_interval or
+                                                    (self.min_steps > 0 and step - self.last_step < self.min_steps))
+        if throttled and not force:
+            self.held = (snapshot, step)
+            return
+
+        self.held = None
+        self.last_time, self.last_step = now, step
+        self.submit(snapshot, step)
+
+    def submit(self, snapshot, step):
+        with self.condition:
+            self.pending.append((snapshot, step))
+            self.condition.notify()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                snapshot, step = self.pending.pop(0)
+            try:
+                data = serialize_state_dict(snapshot)
+                write_checkpoint(data, self.save_paths)
+                if self.keep_last > 0:
+                    self.keep(data, step)
+            except Exception as e:
+                self.error = e
+
+    def keep(self, data, step):
+        name, ext = os.path.splitext(self.save_paths[0])
+        write_checkpoint(data, ['%s-step%d%s' % (name, step, ext)])
+
+        # prune from the files on disk, so copies left by earlier runs in the same dir are pruned too
+        tag = re.compile(re.escape(os.path.basename(name)) + r'-step(\d+)' + re.escape(ext) + '$')
+        kept = []
+        for path in glob.glob(glob.escape(name) + '-step*' + glob.escape(ext)):
+            match = tag.match(os.path.basename(path))
+            if match is not None:
+                kept.append((int(match.group(1)), path))
+        for _, path in sorted(kept)[:-self.keep_last]:
+            os.remove(path)
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """
+        write the held back checkpoint, wait for all the writes to finish
+        """
+        if self.held is not None:
+            self.last_time, self.last_step = time.monotonic(), self.held[1]
+            self.submit(*self.held)
+            self.held = None
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+        self.raise_error()
 
 
 def load_a2c_models(model_path, train_data, network_paths, bidirectional):
@@ -338,17 +1050,18 @@ def get_filename(base_name, bidirectional, curriculum=None):
     return name
 
 
-def calculate_a2cNetwork_score(image_caption_data, save_paths):
+def calculate_a2cNetwork_score(image_caption_data, save_paths, workers=None):
     """
     calculate the a2c network's output and store results in file.
-    @param image_caption_data: dict of the paths for real and generated captions
+    @param image_caption_data: dict of the paths for the caption results
     @param save_paths: dict of the paths to save results data
+    @param workers: number of scoring processes, None for one per core, 1 to score in this process
     """
-    real_captions_filename = image_caption_data["real_captions_path"]
-    generated_captions_filename = image_caption_data["generated_captions_path"]
-
-    ref, hypo = load_textfiles(real_captions_filename, generated_captions_filename)
-    network_score = str(score(ref, hypo))
+    ref, hypo, _ = load_caption_results(image_caption_data["caption_results_path"])
+    if workers == 1:
+        network_score = str(score(ref, hypo))
+    else:
+        network_score = str(parallel_score(ref, hypo, workers))
     print(network_score)
 
     results_filename = os.path.join(save_paths["results_path"])
@@ -364,14 +1077,192 @@ def get_preprocessed_corpus(base_dir):
     @param base_dir: Location of MS-COCO data
     @return: A preprocessed corpus of all captions in the dataset.
     """
-    data = load_data(base_dir=base_dir, max_train=None, print_keys=False)
-    idx_to_word = data["idx_to_word"]
-    corpus_data = [simple_preprocess(" ".join([idx_to_word[d] for d in sent])) for sent in data["train_captions"]]
-    corpus_data += [simple_preprocess(" ".join([idx_to_word[d] for d in sent])) for sent in data["val_captions"]]
+    with open(os.path.join(base_dir, 'coco2014_vocab.json'), 'r') as f:
+        idx_to_word = json.load(f)["idx_to_word"]
+
+    # words are separated by spaces, so tokenizing a caption is the same as tokenizing each of its words
+    word_tokens = [simple_preprocess(w) for w in idx_to_word]
+
+    corpus_data = []
+    with h5py.File(os.path.join(base_dir, 'coco2014_captions.h5'), 'r') as f:
+        for split in ['train', 'val']:
+            for sent in np.asarray(f['%s_captions' % split]):
+                corpus_data.append([t for d in sent for t in word_tokens[d]])
 
     return corpus_data
 
 
+PREPROCESS_CACHE_VERSION = 1  # bump when the cached data layout or its preprocessing changes
+PREPROCESS_MANIFEST_FILE = 'manifest.json'
+PREPROCESS_HASHES_FILE = 'file_hashes.json'  # sha1 of the input files, with the size and mtime they were hashed at
+
+
+def get_file_hash(path, chunk_size=1 << 24):
+    """
+    sha1 of the file contents
+    @param path: file to hash
+    @param chunk_size: bytes read at a time
+    @return: hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_cached_file_hashes(paths, hashes_path):
+    """
+    sha1 of the files, a file is only hashed again when its size or mtime changed since it was last hashed
+    @param paths: files to hash
+    @param hashes_path: json file where the hashes are kept between runs
+    @return: dict of path -> hex digest
+    """
+    try:
+        with open(hashes_path, 'r') as f:
+            hashes = json.load(f)
+    except (OSError, ValueError):
+        hashes = {}
+
+    changed = False
+    file_hashes = {}
+    for path in paths:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = hashes.get(key)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': get_file_hash(path)}
+            hashes[key] = entry
+            changed = True
+        file_hashes[path] = entry['sha1']
+
+    if changed:
+        os.makedirs(os.path.dirname(os.path.abspath(hashes_path)), exist_ok=True)
+        tmp_path = '%s.tmp-%d' % (hashes_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(hashes, f)
+        os.replace(tmp_path, hashes_path)
+    return file_hashes
+
+
+def get_preprocess_cache_key(base_dir, max_train, pca_features, embedding_type, cache_dir):
+    """
+    Key of the preprocessing cache, changes whenever an input file or an option changes
+    @param base_dir: dir where the dataset is stored
+    @param max_train: size of the training subset, None for the full set
+    @param pca_features: whether features with PCA applied are used
+    @param embedding_type: type of trained word embeddings
+    @param cache_dir: dir of the preprocessing cache, the hashes of the input files are kept there
+    @return: hex key
+    """
+    input_files = [h5_name for h5_name, _ in get_h5_files(pca_features)]
+    input_files += ['coco2014_vocab.json', 'train2014_urls.txt', 'val2014_urls.txt']
+    file_hashes = get_cached_file_hashes([os.path.join(base_dir, name) for name in input_files],
+                                         os.path.join(cache_dir, PREPROCESS_HASHES_FILE))
+
+    options = {
+        'version': PREPROCESS_CACHE_VERSION,
+        'max_train': max_train,
+        'pca_features': pca_features,
+        'embedding_type': embedding_type,
+        'inputs': {name: file_hashes[os.path.join(base_dir, name)] for name in input_files},
+    }
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def save_preprocessed_data(data, cache_path):
+    """
+    Store preprocessed data in cache_path. Arrays are saved as .npy files, everything else in the manifest.
+    The directory only appears once it is complete.
+    @param data: the preprocessed dataset
+    @param cache_path: dir of this cache entry
+    """
+    tmp_path = cache_path + '.tmp-%d' % os.getpid()
+    os.makedirs(tmp_path)
+
+    manifest = {'version': PREPROCESS_CACHE_VERSION, 'arrays': [], 'values': {}}
+    for k, v in data.items():
+        if isinstance(v, np.ndarray):
+            np.save(os.path.join(tmp_path, k + '.npy'), v, allow_pickle=False)
+            manifest['arrays'].append(k)
+        else:
+            manifest['values'][k] = v
+
+    with open(os.path.join(tmp_path, PREPROCESS_MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # another process finished the same entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_cached_data(cache_path):
+    """
+    Load a cache entry written by save_preprocessed_data. Arrays are memory-mapped.
+    @param cache_path: dir of this cache entry
+    @return: dict:data, or None when there's no usable entry
+    """
+    manifest_path = os.path.join(cache_path, PREPROCESS_MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != PREPROCESS_CACHE_VERSION:
+        return None
+
+    data = dict(manifest['values'])
+    for k in manifest['arrays']:
+        data[k] = np.load(os.path.join(cache_path, k + '.npy'), mmap_mode='r')
+    return data
+
+
+def load_preprocessed_data(base_dir, max_train=None, embedding_type="none", cache_dir=None, mmap_dir=None,
+                           pca_features=True, print_keys=False):
+    """
+    Load the COCO dataset and train the word embeddings, reusing a cached copy when nothing changed.
+    Cache entries are keyed by the hashes of the input files and the options, so editing an input file or
+    changing an option creates a new entry. Note that a cached max_train subset is reused as is.
+    @param base_dir: dir where the dataset is stored
+    @param max_train: load given size of data, pass None to load full data
+    @param embedding_type: word embeddings to train on the captions ("none", "word2vec" or "fasttext")
+    @param cache_dir: (optional) dir of the preprocessing cache, None to disable caching
+    @param mmap_dir: (optional) memory-map the arrays from this dir, see load_data
+    @param pca_features: whether to load data with PCA applied
+    @param print_keys: whether to print components of the dataset
+    @return: dict:data with dataset and embeddings loaded
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, get_preprocess_cache_key(base_dir, max_train, pca_features,
+                                                                      embedding_type, cache_dir))
+        data = load_cached_data(cache_path)
+        if data is not None:
+            print_green(f'[Info] Loaded preprocessed data from cache {cache_path}')
+            return data
+
+    data = load_data(base_dir=base_dir, max_train=max_train, pca_features=pca_features, print_keys=print_keys,
+                     mmap_dir=mmap_dir)
+
+    if embedding_type != "none":
+        print_green(f'[Info] Loading Word Embeddings {embedding_type}')
+        print_green(f'[Info] Loading Corpus')
+        train_corpus = get_preprocessed_corpus(base_dir)
+        print_green(f'[Info] Corpus Loaded With {len(train_corpus)} Lines')
+        data["embeddings"] = train_word_embeddings(embedding_type, data, train_corpus)
+        print_green(f'[Info] Done Loading Word Embeddings')
+    else:
+        data["embeddings"] = None
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_preprocessed_data(data, cache_path)
+        print_green(f'[Info] Saved preprocessed data to cache {cache_path}')
+
+    return data
+
+
 def get_embeddings(emb_type):
     """
 